@@ -66,8 +66,8 @@ else
                 ;;
             --processor)
                 IMAGE_ID=$(docker images --format "{{.ID}}" --filter=reference="processor-image")
-                docker stop processor-container
-                docker rm processor-container
+                docker stop $(docker ps -aq --filter "name=processor-container")
+                docker rm $(docker ps -aq --filter "name=processor-container")
                 docker rmi $IMAGE_ID
                 docker build -t processor-image -f ./v50_Components/Processor_comp/Dockerfile .
                 ;;
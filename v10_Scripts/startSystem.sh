@@ -25,8 +25,10 @@ docker run -d --rm --network docker-network --name loader-container loader-image
 # Start the Transformer container
 docker run -d --rm --network docker-network --name transformer-container transformer-image
 
-# Start the Processor container
-docker run -d --rm --network docker-network --name processor-container processor-image
+# Start the Processor containers, one instance per region by default (PROCESSOR_INSTANCES overrides it)
+for i in $(seq 1 ${PROCESSOR_INSTANCES:-5}); do
+    docker run -d --rm --network docker-network --name processor-container-$i -e PROCESSOR_ID=processor-$i processor-image
+done
 
 # Start the Realtime container
 docker run -d --rm --network docker-network --name realtime-container realtime-image
@@ -0,0 +1,33 @@
+import os
+import sys
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+LOADER_DIR = os.path.join(TEST_DIR, '..', 'v50_Components', 'Loader_comp')
+sys.path.insert(0, LOADER_DIR)
+from loader import Loader
+
+# Same shape as the regional dataset files: leading index column, quoted headers with commas, -9999 sentinels
+SAMPLE = os.path.join(TEST_DIR, 'fixtures', 'central_west_sample.csv')
+
+
+def test_csv_with_index_column_converts_to_storage_schema():
+    loader = Loader('http://localhost', 9870, 'root', os.path.join(LOADER_DIR, 'configuration.json'))
+    buffer = pa.BufferOutputStream()
+
+    rows = loader.csv_to_parquet(SAMPLE, buffer)
+
+    table = pq.read_table(pa.BufferReader(buffer.getvalue()))
+    assert rows == 6 and table.num_rows == 6
+    assert table.schema.names == loader.schema.names
+    assert str(table['timestamp'][1].as_py()) == '2000-05-07 12:00:00'
+    assert table['prcp'].to_pylist()[:2] == [0.0, 0.0]
+    assert table['stp'][0].as_py() == -9999.0
+    assert [str(prov) for prov in table['prov'].to_pylist()] == ['DF'] * 4 + ['GO'] * 2
+    assert abs(table['elvt'][5].as_py() - 770.0) < 1e-3
+
+
+if __name__ == '__main__':
+    test_csv_with_index_column_converts_to_storage_schema()
+    print("Loader reads the sample csv.")
@@ -0,0 +1,49 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'v50_Components', 'Processor_comp'))
+from calculator import Calculator
+
+# Output of the merge based implementation for the frame below, the grouped computation has to keep it
+EXPECTED = [
+    ('GO', '202301', 867793.3333333333),
+    ('GO', '202302', 708182.2222222221),
+    ('GO', '202303', 875405.5555555555),
+    ('MT', '202301', 860594.4444444445),
+    ('MT', '202302', 702307.4074074074),
+    ('MT', '202303', 868143.5185185187),
+]
+
+
+def build_frame():
+    # Two provinces, four readings a day over three calendar months, every 13th reading missing
+    timestamps = pd.date_range('2023-01-01', '2023-03-31 18:00', freq='6h')
+    provinces = []
+    for index, prov in enumerate(['GO', 'MT']):
+        gbrd = (np.arange(len(timestamps)) * 7 + index * 11) % 50 * 10.0
+        gbrd[::13] = np.nan
+        provinces.append(pd.DataFrame({'timestamp': timestamps, 'prov': prov, 'gbrd': gbrd}))
+    df = pd.concat(provinces).sort_values('timestamp', kind='stable').reset_index(drop=True)
+    # Same derived columns as Processor.to_frame
+    df['date'] = df['timestamp'].dt.normalize()
+    df['year'] = df['timestamp'].dt.year
+    df['month'] = df['timestamp'].dt.month
+    df['hour'] = df['timestamp'].dt.hour
+    return df
+
+
+def test_total_solar_radiation_matches_merge_output():
+    result = Calculator.calculate_total_solar_radiation('central_west', build_frame(), 12)
+
+    assert list(zip(result['prov'], result['period'])) == [(prov, period) for prov, period, _ in EXPECTED]
+    np.testing.assert_allclose(result['total_solar_radiation'].to_numpy(),
+                               [total for _, _, total in EXPECTED], rtol=1e-12)
+    assert (result['region'] == 'central_west').all()
+    assert list(result['date']) == list(pd.to_datetime(['2023-01-01', '2023-02-01', '2023-03-01'] * 2))
+
+
+if __name__ == '__main__':
+    test_total_solar_radiation_matches_merge_output()
+    print("Solar radiation output matches the pinned values.")
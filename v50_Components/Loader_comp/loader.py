@@ -1,17 +1,25 @@
-import pandas as pd
+import csv
+import hashlib
+import json
+import multiprocessing
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
 import pyarrow.parquet as pq
 import os
-import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from hdfs import InsecureClient
 from comm import Comm
+from hdfsstream import HdfsStream
 import time
 import threading
 
 
 class Loader:
-    def __init__(self, hdfs_host, hdfs_port, hdfs_user):
+    def __init__(self, hdfs_host, hdfs_port, hdfs_user, configuration):
         self.hdfs_client = InsecureClient(f"{hdfs_host}:{hdfs_port}", user=hdfs_user)
+        self.hdfs_args = (hdfs_host, hdfs_port, hdfs_user, configuration)
         self.columns = [
             'date', 'hour', 'prcp', 'stp', 'smax', 'smin', 'gbrd',
             'temp', 'dewp', 'tmax', 'tmin', 'dmax', 'dmin',
@@ -25,31 +33,272 @@ class Loader:
             'hmdy': float, 'wdct': float, 'gust': float, 'wdsp': float, 'regi': str,
             'prov': str, 'wsnm': str, 'inme': str, 'lat': float, 'lon': float, 'elvt': float
         }
+        self.categorical = ['regi', 'prov', 'wsnm', 'inme']
+        self.csv_schema = pa.schema([(column, pa.string() if self.dtypes[column] is str else pa.float32())
+                                     for column in self.columns])
+        # Storage schema: date and hour merged into one timestamp, float32 measurements, dictionary encoded stations
+        self.schema = pa.schema(
+            [('timestamp', pa.timestamp('s'))] +
+            [(column, pa.dictionary(pa.int32(), pa.string()) if column in self.categorical else pa.float32())
+             for column in self.columns if column not in ('date', 'hour')]
+        )
+
+        with open(configuration, 'r') as file:
+            config_data = json.load(file)
+            self.block_size = int(config_data["block_size"])
+            self.row_group_size = int(config_data["row_group_size"])
+            self.partitioned = bool(config_data["partitioned"])
+            # Rows of a partitioned upload held in memory before the biggest partitions are written out
+            self.partition_buffer_bytes = int(config_data["partition_buffer_mb"]) * 1024 * 1024
+            self.compression = config_data["compression"]
+            # Only some codecs take a level (zstd, gzip, brotli, lz4), snappy and none reject one so it is dropped
+            self.compression_level = config_data["compression_level"]
+            if self.compression_level is not None and (str(self.compression).lower() == "none" or
+                                                       not pa.Codec.supports_compression_level(self.compression)):
+                self.compression_level = None
+            # Every conversion streams, so its peak memory is bounded by job_memory_mb
+            self.workers = max(1, min(int(config_data["workers"]),
+                                      int(config_data["memory_budget_mb"]) // int(config_data["job_memory_mb"])))
         self.shutdown_event = threading.Event()
+        self.executor = None
+        self.jobs_lock = threading.Lock()
+        self.jobs = {}
+        # Settings that change the uploaded parquet, a change forces reload even for unchanged csv
+        self.output_settings = {"row_group_size": self.row_group_size, "partitioned": self.partitioned,
+                                "schema": self.schema.to_string(), "compression": self.compression,
+                                "compression_level": self.compression_level}
 
-    def process_load_request(self, item, comm):
+    def load_item(self, item):
         csv_file = f'dataset/{item}.csv'
-        if os.path.exists(csv_file):
-            with tempfile.TemporaryDirectory() as temp_dir:
-                parquet_file = os.path.join(temp_dir, f"{item}.parquet")
-                comm.send_info(f"Wrapping {item} to parquet format...")
-                self.csv_to_parquet(csv_file, parquet_file)
-                hdfs_path = f"/datalake/transformed/{item}.parquet"
-                comm.send_info(f"Uploading {item} to HDFS...")
-                self.upload_to_hdfs_webhdfs(parquet_file, hdfs_path)
-                return "success"
-        comm.send_info(f"Uploading of {item} to HDFS failed.")
-        return "failure"
+        if not os.path.exists(csv_file):
+            raise FileNotFoundError(f"{csv_file} does not exist")
+        if self.partitioned:
+            manifest_path = f"/datalake/transformed/{item}/_manifest.json"
+        else:
+            manifest_path = f"/datalake/transformed/{item}.manifest.json"
+
+        stat = os.stat(csv_file)
+        manifest = self.read_manifest(manifest_path)
+        sha256 = None
+        if manifest is not None and manifest["settings"] == self.output_settings and manifest["size"] == stat.st_size:
+            if manifest["mtime_ns"] == stat.st_mtime_ns:
+                return None
+            # Touched but maybe not modified, only the content hash can tell
+            sha256 = self.file_sha256(csv_file)
+            if manifest["sha256"] == sha256:
+                manifest["mtime_ns"] = stat.st_mtime_ns
+                self.write_manifest(manifest_path, manifest)
+                return None
+
+        if sha256 is None:
+            sha256 = self.file_sha256(csv_file)
+        # Manifest goes first so an interrupted upload is never taken as up to date
+        self.hdfs_client.delete(manifest_path)
+        if self.partitioned:
+            rows = self.upload_partitions_to_hdfs(csv_file, f"/datalake/transformed/{item}")
+        else:
+            rows = self.upload_to_hdfs_webhdfs(csv_file, f"/datalake/transformed/{item}.parquet")
+        self.write_manifest(manifest_path, {
+            "source": os.path.basename(csv_file),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256,
+            "settings": self.output_settings
+        })
+        return rows
+
+    def read_manifest(self, manifest_path):
+        if self.hdfs_client.status(manifest_path, strict=False) is None:
+            return None
+        with self.hdfs_client.read(manifest_path, encoding='utf-8') as reader:
+            return json.load(reader)
+
+    def write_manifest(self, manifest_path, manifest):
+        self.hdfs_client.write(manifest_path, json.dumps(manifest), encoding='utf-8', overwrite=True)
+
+    @staticmethod
+    def file_sha256(path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def submit_load_request(self, request_id, item, comm):
+        with self.jobs_lock:
+            if item in self.jobs:
+                # Repeated request while the region is still loading, answer both once the job finishes
+                self.jobs[item].append(request_id)
+                comm.send_info(f"Loading of {item} is already in progress.")
+                return
+            self.jobs[item] = [request_id]
+            running = len(self.jobs)
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+            executor = self.executor
+        comm.send_info(f"Streaming {item} to HDFS in parquet format ({running} loads in progress, "
+                       f"{self.workers} workers)...")
+        try:
+            future = executor.submit(load_region, *self.hdfs_args, item)
+        except Exception as e:
+            comm.send_info(f"Uploading of {item} to HDFS could not be started: {e}")
+            if isinstance(e, BrokenProcessPool):
+                self.drop_executor(executor)
+            self.finish_load_request(item, "failure", comm)
+            return
+        future.add_done_callback(lambda done: self.complete_load_request(item, done, executor, comm))
+
+    def drop_executor(self, executor):
+        # A worker that died (e.g. killed for running out of memory) breaks the whole pool, every later submit
+        # would fail, so the next request starts a new one
+        with self.jobs_lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def complete_load_request(self, item, future, executor, comm):
+        try:
+            rows = future.result()
+            if rows is None:
+                comm.send_info(f"Source of {item} is unchanged since the last load, skipping upload.")
+            else:
+                comm.send_info(f"Loaded {rows} rows of {item} to HDFS.")
+            result = "success"
+        except Exception as e:
+            comm.send_info(f"Uploading of {item} to HDFS failed: {e}")
+            if isinstance(e, BrokenProcessPool):
+                self.drop_executor(executor)
+            result = "failure"
+        self.finish_load_request(item, result, comm)
+
+    def finish_load_request(self, item, result, comm):
+        # Answers every request waiting for the region
+        with self.jobs_lock:
+            request_ids = self.jobs.pop(item)
+        for request_id in request_ids:
+            comm.client.publish(comm.response_topic, f"{request_id}:load:{item}:{result}")
+
+    def csv_column_names(self, csv_file):
+        # Regional csv files start with an index column, the data are always the last len(columns) fields
+        with open(csv_file, newline='', encoding='utf-8', errors='replace') as file:
+            header = next(csv.reader(file), [])
+        extra = max(0, len(header) - len(self.columns))
+        return [f"_extra{index}" for index in range(extra)] + self.columns
+
+    def open_csv(self, csv_file):
+        # Stream the csv block by block so memory does not grow with the size of the region
+        return pv.open_csv(
+            csv_file,
+            read_options=pv.ReadOptions(column_names=self.csv_column_names(csv_file), skip_rows=1,
+                                        block_size=self.block_size),
+            convert_options=pv.ConvertOptions(column_types=self.csv_schema, include_columns=self.columns,
+                                              strings_can_be_null=True)
+        )
 
     def csv_to_parquet(self, csv_file, parquet_file):
-        df = pd.read_csv(csv_file, names=self.columns, dtype=self.dtypes, skiprows=1)
-        df['prcp'] = df['prcp'].fillna(0)
-        table = pa.Table.from_pandas(df)
-        pq.write_table(table, parquet_file)
+        rows = 0
+        pending = []
+        pending_rows = 0
+        with pq.ParquetWriter(parquet_file, self.schema, compression=self.compression,
+                              compression_level=self.compression_level) as writer:
+            for batch in self.open_csv(csv_file):
+                pending.append(self.to_storage(batch))
+                pending_rows += batch.num_rows
+                rows += batch.num_rows
+                if pending_rows >= self.row_group_size:
+                    # Flush only full row groups, the remainder waits for the next blocks
+                    table = pa.Table.from_batches(pending, schema=self.schema)
+                    full_rows = pending_rows - pending_rows % self.row_group_size
+                    writer.write_table(table.slice(0, full_rows), row_group_size=self.row_group_size)
+                    pending = table.slice(full_rows).to_batches()
+                    pending_rows -= full_rows
+            if pending_rows:
+                writer.write_table(pa.Table.from_batches(pending, schema=self.schema),
+                                   row_group_size=self.row_group_size)
+        return rows
+
+    def upload_partitions_to_hdfs(self, csv_file, hdfs_root):
+        # Hive style layout prov=../year=../month=... The csv is ordered by station, so every block touches most
+        # partitions: rows are buffered per partition and written once a partition fills a row group or, when the
+        # buffer is full, from the biggest partitions down. A partition ends up in a few part files, not one per block
+        self.hdfs_client.delete(hdfs_root, recursive=True)
+        rows = 0
+        buffered = {}
+        buffered_bytes = 0
+        parts = {}
+        for batch in self.open_csv(csv_file):
+            rows += batch.num_rows
+            table = pa.Table.from_batches([self.to_storage(batch)], schema=self.schema)
+            for partition, partition_table in self.split_partitions(table):
+                pending = buffered.setdefault(partition, {"tables": [], "rows": 0, "bytes": 0})
+                pending["tables"].append(partition_table)
+                pending["rows"] += partition_table.num_rows
+                pending["bytes"] += partition_table.nbytes
+                buffered_bytes += partition_table.nbytes
+            full = [partition for partition, pending in buffered.items() if pending["rows"] >= self.row_group_size]
+            if buffered_bytes > self.partition_buffer_bytes:
+                # Down to half of the buffer, so the next blocks do not flush again right away
+                largest = sorted(buffered, key=lambda partition: buffered[partition]["bytes"], reverse=True)
+                freed = sum(buffered[partition]["bytes"] for partition in full)
+                for partition in largest:
+                    if buffered_bytes - freed <= self.partition_buffer_bytes // 2:
+                        break
+                    if partition not in full:
+                        full.append(partition)
+                        freed += buffered[partition]["bytes"]
+            for partition in full:
+                pending = buffered.pop(partition)
+                buffered_bytes -= pending["bytes"]
+                self.write_partition(hdfs_root, partition, pending["tables"], parts)
+        for partition, pending in buffered.items():
+            self.write_partition(hdfs_root, partition, pending["tables"], parts)
+        return rows
 
-    def upload_to_hdfs_webhdfs(self, local_path, hdfs_path):
-        with open(local_path, 'rb') as local_file:
-            self.hdfs_client.write(hdfs_path, local_file, overwrite=True)
+    def write_partition(self, hdfs_root, partition, tables, parts):
+        part = parts.get(partition, 0)
+        parts[partition] = part + 1
+        buffer = pa.BufferOutputStream()
+        pq.write_table(pa.concat_tables(tables), buffer, row_group_size=self.row_group_size,
+                       compression=self.compression, compression_level=self.compression_level)
+        self.hdfs_client.write(f"{hdfs_root}/{partition}/part-{part:05d}.parquet", buffer.getvalue(), overwrite=True)
+
+    @staticmethod
+    def split_partitions(table):
+        year = pc.year(table['timestamp'])
+        month = pc.month(table['timestamp'])
+        keys = pc.binary_join_element_wise(
+            pc.fill_null(pc.binary_join_element_wise("prov=", pc.cast(table['prov'], pa.string()), ""),
+                         "prov=__HIVE_DEFAULT_PARTITION__"),
+            pc.fill_null(pc.binary_join_element_wise("year=", pc.cast(year, pa.string()), ""),
+                         "year=__HIVE_DEFAULT_PARTITION__"),
+            pc.fill_null(pc.binary_join_element_wise("month=", pc.cast(month, pa.string()), ""),
+                         "month=__HIVE_DEFAULT_PARTITION__"),
+            "/"
+        )
+        for partition in pc.unique(keys).to_pylist():
+            yield partition, table.filter(pc.equal(keys, partition))
+
+    def to_storage(self, batch):
+        timestamp = pc.strptime(pc.binary_join_element_wise(batch.column('date'), batch.column('hour'), ' '),
+                                format='%Y-%m-%d %H:%M', unit='s', error_is_null=True)
+        columns = [timestamp]
+        for field in self.schema:
+            if field.name == 'timestamp':
+                continue
+            column = batch.column(field.name)
+            if field.name == 'prcp':
+                column = pc.fill_null(column, 0.0)
+            elif field.name in self.categorical:
+                column = pc.dictionary_encode(column)
+            columns.append(column)
+        return pa.RecordBatch.from_arrays(columns, schema=self.schema)
+
+    def upload_to_hdfs_webhdfs(self, csv_file, hdfs_path):
+        # Row groups are handed to the WebHDFS upload as soon as they are written,
+        # so parsing and uploading overlap and nothing is staged on local disk
+        with HdfsStream(self.hdfs_client, hdfs_path) as hdfs_stream:
+            return self.csv_to_parquet(csv_file, hdfs_stream)
 
     def handle_request(self, payload, comm):
         parts = payload.split(":")
@@ -59,8 +308,8 @@ class Loader:
         request_id, command, item = parts
         if command == "load":
             comm.send_info(f"Received request to load {item}")
-            result = self.process_load_request(item, comm)
-            return f"{request_id}:{command}:{item}:{result}"
+            self.submit_load_request(request_id, item, comm)
+            return None
         elif command == "alive" and item == "request":
             comm.send_info("Alive => Running...")
             return f"{request_id}:loader:alive:waiting"
@@ -73,12 +322,21 @@ class Loader:
             return f"{request_id}:{command}:{item}:error"
 
 
+def load_region(hdfs_host, hdfs_port, hdfs_user, configuration, item):
+    # Runs inside a pool worker process, each worker builds its own HDFS client
+    loader = Loader(hdfs_host, hdfs_port, hdfs_user, configuration)
+    return loader.load_item(item)
+
+
 def main():
-    loader = Loader('http://hadoop-container', 9870, 'root')
+    loader = Loader('http://hadoop-container', 9870, 'root', 'configuration.json')
     comm = Comm("mqtt-broker", "loader", "response")
 
     comm.start(loader.handle_request)
     loader.shutdown_event.wait()
+    if loader.executor is not None:
+        comm.send_info("Waiting for running loads to finish...")
+        loader.executor.shutdown(wait=True)
     comm.send_info("Shutting down communication...")
     comm.send_info("Shutting down...")
     comm.stop()
@@ -2,7 +2,7 @@ import paho.mqtt.client as mqtt
 import threading
 import time
 import uuid
-from runtime import Runtime, Task
+from runtime import Runtime, Stage, Task
 from comm import Comm
 from logger import Logger
 
@@ -11,7 +11,7 @@ class Marshaller:
     def __init__(self, instance, broker_address):
         self.shutdown_event = threading.Event()
         self.broker_address = broker_address
-        self.comm = Comm(instance, broker_address, ["marshaller", "response"])
+        self.comm = Comm(instance, broker_address, ["marshaller", "response", "processor_status"])
         self.runtime = Runtime()
 
     def alive_ping(self, component):
@@ -38,6 +38,23 @@ class Marshaller:
 
         return response
 
+    def send_request_async(self, request_topic, request_message, timeout, callback):
+        # Returns right away, callback gets the response (None after timeout) whenever it arrives, so requests
+        # complete in any order
+        request_id = str(uuid.uuid4())
+        timer = threading.Timer(timeout, self.expire_request, args=(request_id,))
+        timer.daemon = True
+        self.runtime.response_events[request_id] = {'callback': callback, 'timer': timer}
+
+        self.comm.client.publish(request_topic, f"{request_id}:{request_message}")
+        self.comm.send_info(f"Sent request to {request_topic}: {request_message}")
+        timer.start()
+
+    def expire_request(self, request_id):
+        pending = self.runtime.response_events.pop(request_id, None)
+        if pending is not None:
+            pending['callback'](None)
+
     def on_message(self, client, userdata, message):
         topic = message.topic
         payload = str(message.payload.decode('utf-8'))
@@ -45,19 +62,31 @@ class Marshaller:
             request_id, response_message = payload.split(':', 1)
             self.comm.send_info(f"Received response on topic {topic}: {response_message}")
 
-            if request_id in self.runtime.response_events:
-                self.runtime.response_events[request_id]['response'] = response_message
-                self.runtime.response_events[request_id]['event'].set()
+            pending = self.runtime.response_events.get(request_id)
+            if pending is not None and 'callback' in pending:
+                # Whoever takes the request out first, response or timer, completes it
+                if self.runtime.response_events.pop(request_id, None) is not None:
+                    pending['timer'].cancel()
+                    pending['callback'](response_message)
+            elif pending is not None:
+                pending['response'] = response_message
+                pending['event'].set()
 
         elif "marshaller" == topic:
             self.handle_ui(payload)
 
+        elif "processor_status" == topic:
+            # instance:jobs:region,region,... announced periodically by every Processor instance
+            instance, jobs, regions = payload.split(":")
+            if self.runtime.update_processor(instance, int(jobs), [region for region in regions.split(",") if region]):
+                self.runtime.notify("processor")
+
         else:
             self.comm.send_info(f"Unknown topic: {payload}")
 
     def handle_hdfs(self):
         while not self.runtime.system_shutdown:
-            self.default_sleep()
+            self.wait_for_work("hdfs")
             if not self.runtime.hadoop_status:
                 if self.alive_ping("hdfs"):
                     self.runtime.hadoop_status = True
@@ -71,6 +100,7 @@ class Marshaller:
                 if response == "hdfs:start:success":
                     self.runtime.hadoop_services = True
                     self.comm.send_info("Successfully started HDFS.")
+                    self.runtime.notify("loader", "transformer", "processor")
                 elif response == "hdfs:start:failure":
                     self.comm.send_info("Trying to start HDFS again.")
                 else:
@@ -96,44 +126,46 @@ class Marshaller:
 
     def handle_loader(self):
         while not self.runtime.system_shutdown:
-            if len(self.runtime.loader_completed) == len(self.runtime.data):
+            if not self.runtime.regions_in(Stage.LOAD):
                 break
-            for item in self.runtime.data:
-                self.default_sleep()
-
-                if self.runtime.system_shutdown:
-                    break
+            self.wait_for_work("loader")
 
-                if not self.runtime.loader_status:
-                    if self.alive_ping("loader"):
-                        self.runtime.loader_status = True
-                        self.comm.send_info("Loader component is alive")
-                    else:
-                        self.runtime.loader_status = False
-                        break
+            if not self.runtime.loader_status:
+                if self.alive_ping("loader"):
+                    self.runtime.loader_status = True
+                    self.comm.send_info("Loader component is alive")
+                else:
+                    self.runtime.loader_status = False
+                    continue
 
-                if not self.runtime.hadoop_services or not self.runtime.hadoop_status:
-                    break
+            if not self.runtime.hadoop_services or not self.runtime.hadoop_status:
+                continue
 
-                if item not in self.runtime.loader_completed:
-                    response = self.send_request_and_wait("loader", f"load:{item}", self.runtime.time_threshold)
-                    if response is not None:
-                        if response == f"load:{item}:success":
-                            self.comm.send_info(f"Success for loading: {item}")
-                            self.runtime.transformer_task.append(item)
-                            self.runtime.loader_completed.append(item)
-                            break
-                        elif response == f"load:{item}:failure":
-                            self.comm.send_info(f"Failed Re-requesting loading of: {item}")
-                        else:
-                            self.comm.send_info(f"Unknown error (loader)")
-                    else:
-                        self.comm.send_info("Marshaller: Timeout for load request.")
+            # Every finished load frees a slot of the window for the next region
+            for item in self.runtime.regions_in(Stage.LOAD):
+                if self.runtime.acquire_slot("loader", item):
+                    self.send_request_async("loader", f"load:{item}", self.runtime.time_threshold,
+                                            lambda response, item=item: self.complete_load(item, response))
         return self.shut_down_component("loader")
 
+    def complete_load(self, item, response):
+        self.runtime.release_slot("loader", item)
+        if response is not None:
+            if response == f"load:{item}:success":
+                self.comm.send_info(f"Success for loading: {item}")
+                # Transformer starts on the region right away, the next loads follow without a pause
+                self.runtime.complete_stage(item, Stage.LOAD)
+                self.runtime.notify("loader")
+            elif response == f"load:{item}:failure":
+                self.comm.send_info(f"Failed Re-requesting loading of: {item}")
+            else:
+                self.comm.send_info(f"Unknown error (loader)")
+        else:
+            self.comm.send_info("Marshaller: Timeout for load request.")
+
     def handle_transformer(self):
         while not self.runtime.system_shutdown:
-            self.default_sleep()
+            self.wait_for_work("transformer")
 
             if not self.runtime.transformer_status:
                 if self.alive_ping("transformer"):
@@ -143,22 +175,29 @@ class Marshaller:
                     self.runtime.transformer_status = False
                     continue
 
-            if self.runtime.transformed == len(self.runtime.data):
+            if not self.runtime.regions_in(Stage.LOAD, Stage.TRANSFORM, Stage.AGGREGATE):
                 return self.shut_down_component("transformer")
 
             if not self.runtime.hadoop_services or not self.runtime.hadoop_status:
                 continue
 
-            for item in self.runtime.transformer_task:
+            for item in self.runtime.regions_in(Stage.TRANSFORM):
                 if self.runtime.system_shutdown:
                     break
                 response = self.send_request_and_wait("transformer", f"transform:{item}", self.runtime.time_threshold)
                 if response is not None:
                     if response == f"transform:{item}:success":
                         self.comm.send_info(f"Success for transforming: {item}")
-                        self.runtime.transformer_task.remove(item)
-                        self.runtime.processor_region.append(item)
-                        self.runtime.transformed += 1
+                        self.runtime.complete_stage(item, Stage.TRANSFORM)
+                        # Processor falls back to curated data when the cube could not be built
+                        if self.send_request_and_wait("transformer", f"aggregate:{item}",
+                                                      self.runtime.time_threshold) != f"aggregate:{item}:success":
+                            self.comm.send_info(f"Aggregating {item} failed, processor will use curated data.")
+                        # Processor may still hold the previous version of the region, it is told before any
+                        # task of the region can be dispatched
+                        self.comm.client.publish("processor", f"{uuid.uuid4()}:invalidate:{item}")
+                        # Parked tasks of the region go back to the queue and the Processor worker is woken
+                        self.runtime.complete_stage(item, Stage.AGGREGATE)
                         break
                     elif response == f"transform:{item}:failure":
                         self.comm.send_info(f"Failed Re-requesting transforming of: {item}")
@@ -171,7 +210,7 @@ class Marshaller:
 
     def handle_processor(self):
         while not self.runtime.system_shutdown:
-            self.default_sleep()
+            self.wait_for_work("processor")
 
             if not self.runtime.processor_status:
                 if self.alive_ping("processor"):
@@ -198,51 +237,93 @@ class Marshaller:
                     self.comm.client.publish("ui", f"marshaller:all:{temp_task.operation}:{temp_task.period}:success")
                     self.runtime.task_clusters.remove(group)
 
-            task = self.runtime.get_task()
-
-            if task is None:
+            if not self.runtime.queue_size:
                 Logger.write_output("Processor: No tasks in queue")
                 continue
 
-            if self.runtime.task_has_been_processed(task):
-                self.comm.send_info("Requested task has already been processed!")
-                if self.runtime.ui_has_requested_task(task):
-                    Logger.write_output(
-                        f"UI: Request for region: {task.region}, calculation: {task.operation} for duration {task.period} is ready.")
-                    self.comm.client.publish("ui", f"marshaller:{task.region}:{task.operation}:{task.period}:success")
-                continue
+            # Batches of different regions go out to different instances at the same time, a batch waits in the
+            # queue while no instance can take it. Only regions that are ready come out of the queue, and nothing does
+            # once every window is full, the next free slot wakes the worker again
+            deferred = []
+            while not self.runtime.system_shutdown and self.runtime.has_free_processor():
+                tasks = self.runtime.get_task_batch()
+                if not tasks:
+                    break
 
-            # Check if the region is available (already transformed in curated zone)
-            if not self.runtime.is_region_available(task.region):
-                # Re-queue the task with low priority
-                self.runtime.put_task(task, priority=False)
-                self.comm.send_info(f"Region {task.region} is not available for processing, re-queueing task.")
-                continue
+                pending = []
+                for task in tasks:
+                    if self.runtime.task_has_been_processed(task):
+                        self.comm.send_info("Requested task has already been processed!")
+                        self.notify_ui(task, self.runtime.take_answered(task), "success")
+                        continue
+                    pending.append(task)
 
-            response = self.send_request_and_wait("processor", f"{task.operation}:{task.region}:{task.period}",
-                                                  self.runtime.time_threshold)
-            if response is not None:
-                if response == f"{task.operation}:{task.region}:{task.period}:success":
-                    self.comm.send_info(
-                        f"Success for calculating {task.operation} for {task.region}, period: {task.period}")
-                    self.runtime.processed_tasks.append(task)
-                    if self.runtime.ui_has_requested_task(task):
-                        Logger.write_output(
-                            f"UI: Request for region: {task.region}, calculation: {task.operation} for duration {task.period} is ready.")
-                        self.comm.client.publish("ui",
-                                                 f"marshaller:{task.region}:{task.operation}:{task.period}:success")
-                elif response == f"{task.operation}:{task.region}:{task.period}:failure":
-                    self.comm.send_info(f"Failed Re-requesting calculation of {task.operation} for {task.region}")
+                if not pending:
+                    continue
+
+                region = pending[0].region
+                instance = self.runtime.acquire_processor(region)
+                if instance is None:
+                    deferred.extend(pending)
+                    continue
+                self.runtime.start_tasks(pending)
+                self.dispatch_batch(instance, region, pending)
+
+            # Tasks that had to wait keep their place at the front of the queue
+            for task in reversed(deferred):
+                self.runtime.put_task(task, priority=True)
+        return self.shut_down_component("processor")
+
+    def dispatch_batch(self, instance, region, pending):
+        # All tasks of the region go in one batch request: batch:region:operation=period;...
+        specification = ";".join(f"{task.operation}={task.period}" for task in pending)
+        self.send_request_async(f"processor/{instance}", f"batch:{region}:{specification}",
+                                self.runtime.time_threshold,
+                                lambda response: self.complete_batch(instance, region, pending, response))
+
+    def complete_batch(self, instance, region, pending, response):
+        self.runtime.release_processor(instance)
+        # A slot of the instance is free again, waiting batches can go out
+        self.runtime.notify("processor")
+        if response is None:
+            # Instance is gone, its tasks go back to the queue for the remaining instances
+            self.comm.send_info(f"Timeout for processor request, dropping processor instance {instance}.")
+            self.runtime.remove_processor(instance)
+            for task in pending:
+                if not self.runtime.requeue_task(task):
+                    self.comm.send_info(f"Giving up on {task.operation} for {task.region}, no processor answered.")
+                    _, failed = self.runtime.complete_task(task, False)
+                    self.notify_ui(task, failed, "failure")
+            return
+        outcome = {}
+        if response.startswith(f"batch:{region}:"):
+            outcome = dict(item.rsplit("=", 1) for item in response[len(f"batch:{region}:"):].split(";"))
+        for task in pending:
+            status = outcome.get(f"{task.operation}={task.period}")
+            if status == "success":
+                self.comm.send_info(
+                    f"Success for calculating {task.operation} for {task.region}, period: {task.period}")
+                answered, _ = self.runtime.complete_task(task, True)
+                self.notify_ui(task, answered, "success")
+            else:
+                if status == "failure":
+                    self.comm.send_info(f"Failed calculation of {task.operation} for {task.region}")
                 else:
                     self.comm.send_info(f"Unknown error (processor)")
-            else:
-                self.comm.send_info("Timeout for processor request.")
-                self.runtime.processor_status = False
-        return self.shut_down_component("processor")
+                _, failed = self.runtime.complete_task(task, False)
+                self.notify_ui(task, failed, "failure")
+
+    def notify_ui(self, task, periods, state):
+        # One publish per requested period reaches every UI waiting for it
+        outcome = "ready" if state == "success" else "failed"
+        for period in periods:
+            Logger.write_output(
+                f"UI: Request for region: {task.region}, calculation: {task.operation} for duration {period} is {outcome}.")
+            self.comm.client.publish("ui", f"marshaller:{task.region}:{task.operation}:{period}:{state}")
 
     def handle_relatime(self):
         while not self.runtime.system_shutdown:
-            self.default_sleep()
+            self.wait_for_work("realtime")
 
             if not self.runtime.realtime_status:
                 if self.alive_ping("realtime"):
@@ -299,16 +380,18 @@ class Marshaller:
         region, command, period = parts
         if command == "shutdown":
             self.runtime.system_shutdown = True
+            self.runtime.notify_all()
         else:
             Logger.write_output(f"UI: Has requested {command} for region: {region} for period {period}")
             if "all" == region:
                 task_group = []
                 for item in self.runtime.data:
-                    self.runtime.prioritize_task(Task(item, command, int(period)), all_regions=True)
+                    self.runtime.request_task(Task(item, command, int(period)), all_regions=True)
                     task_group.append(Task(item, command, int(period)))
                 self.runtime.task_clusters.append(task_group)
-            else:
-                self.runtime.prioritize_task(Task(region, command, int(period)), all_regions=False)
+            elif self.runtime.request_task(Task(region, command, int(period))):
+                self.notify_ui(Task(region, command, int(period)), [int(period)], "success")
+            self.runtime.notify("processor")
 
     def shut_down_component(self, component):
         while True:
@@ -333,6 +416,10 @@ class Marshaller:
             self.runtime.hadoop_status = status
             self.runtime.hadoop_services = status
 
+    def wait_for_work(self, worker):
+        # Sleeps like default_sleep unless something the worker waits for happens earlier
+        self.runtime.wait_for_work(worker, self.runtime.sleep_duration)
+
     def default_sleep(self):
         time.sleep(self.runtime.sleep_duration)
 
@@ -1,13 +1,36 @@
+import heapq
+import itertools
 import json
 import threading
-from collections import deque
+import time
 
 
 class Task:
-    def __init__(self, region, operation, period):
+    # Priority classes, lower goes first: single UI requests, UI requests for all regions, configured batch tasks
+    UI = 0
+    CLUSTER = 1
+    BATCH = 2
+
+    def __init__(self, region, operation, period, priority=BATCH):
         self.region = region
         self.operation = operation
         self.period = period
+        self.priority = priority
+        # Place within the priority class, given when the task is queued for the first time
+        self.sequence = None
+        # Times the task went back to the queue because its processor stopped responding
+        self.requeues = 0
+
+
+class Stage:
+    # Pipeline every region goes through, a stage starts for the region as soon as the one before it has finished
+    LOAD = "load"
+    TRANSFORM = "transform"
+    AGGREGATE = "aggregate"
+    READY = "ready"
+    NEXT = {LOAD: TRANSFORM, TRANSFORM: AGGREGATE, AGGREGATE: READY}
+    # Worker that runs the stage
+    WORKERS = {LOAD: "loader", TRANSFORM: "transformer", AGGREGATE: "transformer", READY: "processor"}
 
 
 class Runtime:
@@ -26,6 +49,13 @@ class Runtime:
         self.batch_tasks = json_config['batch_tasks']
         self.realtime_tasks = json_config['realtime_tasks']
         self.sleep_duration = int(json_config['default_sleep'])
+        # Component -> requests that may be unanswered at the same time (per instance for the Processor)
+        self._in_flight_windows = {component: int(window) for component, window in json_config['in_flight'].items()}
+        self._max_batch_size = int(json_config['max_batch_size'])
+        # Processor instances that have not announced themselves for this long are considered gone
+        self._processor_timeout = int(json_config['processor_timeout'])
+        # A task that has outlived this many processors fails instead of going to the next one
+        self._max_requeues = int(json_config['max_requeues'])
         self.shutdown_components = json_config['shutdown_components']
 
         # Global variables
@@ -38,20 +68,42 @@ class Runtime:
         self._realtime_running = False
         self._system_shutdown = False
         self._realtime_configuration = False
-        self._queue = deque()
+        # Heap of [priority, sequence, tie, task] entries, an entry removed from the middle has its task set to None.
+        # Queued entries are indexed by region and (operation, period), so lookups and batches never scan the heap
+        self._heap = []
+        self._queued = {}
+        # Number of indexed entries, kept up to date so the queue size never walks the index
+        self._queued_size = 0
+        self._counter = itertools.count()
         self._response_events = {}
-        self._loader_completed = []
-        self._transformer_task = []
-        self._processor_region = []
-        self._processed_tasks = []
+        # Component -> items sent to it and not answered yet
+        self._in_flight = {component: set() for component in self._in_flight_windows}
+        # Region -> stage it is waiting for, tasks of a region are only dispatched once it is ready
+        self._stages = {region: Stage.LOAD for region in self._data}
+        # Region -> queue entries popped before the region was ready, pushed back when it gets there
+        self._parked = {}
+        # (region, operation) -> longest period processed, it covers every shorter period
+        self._processed = {}
         self._task_clusters = []
-        self._ui_requests = []
-        self._transformed = 0
+        # (region, operation) -> period -> number of single UI requests waiting for it
+        self._ui_requests = {}
+        # (region, operation) -> period -> number of such tasks sent to processors and not answered yet
+        self._running = {}
+        # Worker -> event set when something it waits for has changed, so it runs right away instead of sleeping
+        self._wakeups = {worker: threading.Event() for worker in ["hdfs", "loader", "transformer", "processor",
+                                                                  "realtime"]}
+        # Processor instance -> announced jobs and warm regions and time of the last announcement
+        self._processors = {}
+        # Processor instance -> batches sent and not answered yet. Kept apart from the announcements, an instance that
+        # was dropped and announces itself again still has its earlier batches counted until they are answered
+        self._processor_batches = {}
+        # Region -> instance it was last sent to, kept until the instance announces it has the region warm
+        self._region_owners = {}
 
         # Sort the batch_tasks by region
         sorted_tasks = sorted(self.batch_tasks, key=lambda x: x.get('region'))
         for task in sorted_tasks:
-            self._queue.append(Task(task.get('region'), task.get('operation'), int(task.get('period'))))
+            self._push_task(Task(task.get('region'), task.get('operation'), int(task.get('period'))))
 
     @property
     def data(self):
@@ -103,6 +155,16 @@ class Runtime:
         with self.lock:
             self._sleep_duration = value
 
+    @property
+    def max_batch_size(self):
+        with self.lock:
+            return self._max_batch_size
+
+    @max_batch_size.setter
+    def max_batch_size(self, value):
+        with self.lock:
+            self._max_batch_size = value
+
     @property
     def hadoop_services(self):
         with self.lock:
@@ -213,36 +275,6 @@ class Runtime:
         with self.lock:
             self._response_events = value
 
-    @property
-    def loader_completed(self):
-        with self.lock:
-            return self._loader_completed
-
-    @loader_completed.setter
-    def loader_completed(self, value):
-        with self.lock:
-            self._loader_completed = value
-
-    @property
-    def transformer_task(self):
-        with self.lock:
-            return self._transformer_task
-
-    @transformer_task.setter
-    def transformer_task(self, value):
-        with self.lock:
-            self._transformer_task = value
-
-    @property
-    def processed_tasks(self):
-        with self.lock:
-            return self._processed_tasks
-
-    @processed_tasks.setter
-    def processed_tasks(self, value):
-        with self.lock:
-            self._processed_tasks = value
-
     @property
     def task_clusters(self):
         with self.lock:
@@ -253,91 +285,257 @@ class Runtime:
         with self.lock:
             self._task_clusters = value
 
-    @property
-    def ui_requests(self):
+    def regions_in(self, *stages):
+        # Regions waiting for any of the stages, in configured order
         with self.lock:
-            return self._ui_requests
+            return [region for region in self._data if self._stages[region] in stages]
 
-    @ui_requests.setter
-    def ui_requests(self, value):
+    def complete_stage(self, region, stage):
+        # Moves the region on and wakes the worker of the next stage right away
         with self.lock:
-            self._ui_requests = value
+            if self._stages[region] != stage:
+                return
+            self._stages[region] = Stage.NEXT[stage]
+            if self._stages[region] == Stage.READY:
+                for entry in self._parked.pop(region, []):
+                    heapq.heappush(self._heap, entry)
+        self.notify(Stage.WORKERS[Stage.NEXT[stage]])
 
     @property
-    def processor_region(self):
+    def queue_size(self):
         with self.lock:
-            return self._processor_region
+            return self._queued_size
 
-    @processor_region.setter
-    def processor_region(self, value):
-        with self.lock:
-            self._processor_region = value
+    def notify(self, *workers):
+        for worker in workers:
+            self._wakeups[worker].set()
+
+    def notify_all(self):
+        self.notify(*self._wakeups)
+
+    def wait_for_work(self, worker, timeout):
+        # Returns when the worker is notified, or after timeout so failed requests are still retried
+        wakeup = self._wakeups[worker]
+        wakeup.wait(timeout)
+        wakeup.clear()
 
-    def is_region_available(self, region):
+    def acquire_slot(self, component, item):
+        # False when the component's window is full or the item is already on its way
         with self.lock:
-            return region in self._processor_region
+            in_flight = self._in_flight[component]
+            if item in in_flight or len(in_flight) >= self._in_flight_windows[component]:
+                return False
+            in_flight.add(item)
+            return True
 
-    @property
-    def transformed(self):
+    def release_slot(self, component, item):
         with self.lock:
-            return self._transformed
+            self._in_flight[component].discard(item)
 
-    @transformed.setter
-    def transformed(self, value):
+    def update_processor(self, instance, jobs, regions):
+        # Returns True for an instance that was not known yet
         with self.lock:
-            self._transformed = value
+            known = instance in self._processors
+            processor = self._processors.setdefault(instance, {})
+            processor.update(jobs=jobs, regions=set(regions), seen=time.time())
+            return not known
 
-    @property
-    def queue(self):
+    def remove_processor(self, instance):
         with self.lock:
-            return self._queue
+            self._processors.pop(instance, None)
+            for region in [region for region, owner in self._region_owners.items() if owner == instance]:
+                del self._region_owners[region]
 
-    def put_task(self, task, priority=False):
+    def _live_processors(self):
+        # Lock must be held. Instances that announced themselves within processor_timeout
+        deadline = time.time() - self._processor_timeout
+        return {instance: processor for instance, processor in self._processors.items()
+                if processor['seen'] >= deadline}
+
+    def has_free_processor(self):
+        # True while some live instance has room in its in-flight window
         with self.lock:
-            if priority:
-                self._queue.appendleft(task)
-            else:
-                self._queue.append(task)
+            window = self._in_flight_windows['processor']
+            return any(self._processor_batches.get(instance, 0) < window for instance in self._live_processors())
 
-    def get_task(self):
+    def acquire_processor(self, region):
+        # Instance for the next batch of the region: the one holding the region, or the least loaded instance with
+        # room in its in-flight window. Returns None when no window has room or the owner is full and nobody is idle
         with self.lock:
-            if self._queue:
-                return self._queue.popleft()
-            else:
+            window = self._in_flight_windows['processor']
+            live = self._live_processors()
+            batches = self._processor_batches
+            free = {instance: processor for instance, processor in live.items() if batches.get(instance, 0) < window}
+            if not free:
                 return None
+            owner = self._region_owners.get(region)
+            if owner not in live:
+                owner = next((instance for instance, processor in live.items() if region in processor['regions']), None)
+            if owner in free:
+                chosen = owner
+            else:
+                chosen = min(free, key=lambda instance: (batches.get(instance, 0), free[instance]['jobs'],
+                                                         len(free[instance]['regions'])))
+                # A full owner only loses the region to an instance with nothing to do
+                if owner is not None and (batches.get(chosen, 0) or free[chosen]['jobs']):
+                    return None
+            batches[chosen] = batches.get(chosen, 0) + 1
+            self._region_owners[region] = chosen
+            return chosen
+
+    def release_processor(self, instance):
+        with self.lock:
+            batches = self._processor_batches.get(instance, 0) - 1
+            if batches > 0:
+                self._processor_batches[instance] = batches
+            else:
+                self._processor_batches.pop(instance, None)
+
+    def _push_task(self, task, keep_place=False):
+        # Lock must be held. A task already queued keeps the better of both priorities
+        queued = self._queued.get(task.region, {}).get(task.operation, {}).get(task.period)
+        if queued is not None:
+            if queued[0] <= task.priority:
+                return False
+            self._remove_entry(queued)
+        if not keep_place or task.sequence is None:
+            task.sequence = next(self._counter)
+        entry = [task.priority, task.sequence, next(self._counter), task]
+        heapq.heappush(self._heap, entry)
+        self._queued.setdefault(task.region, {}).setdefault(task.operation, {})[task.period] = entry
+        self._queued_size += 1
+        return True
+
+    def _remove_entry(self, entry):
+        # Lock must be held. The entry stays in the heap until it surfaces, the heap is rebuilt once most of it is stale
+        task = entry[3]
+        self._unindex_task(task)
+        entry[3] = None
+        if len(self._heap) > 64 and len(self._heap) > 2 * self._queued_size:
+            self._heap = [item for item in self._heap if item[3] is not None]
+            heapq.heapify(self._heap)
+
+    def _unindex_task(self, task):
+        region_tasks = self._queued[task.region]
+        operation_tasks = region_tasks[task.operation]
+        del operation_tasks[task.period]
+        if not operation_tasks:
+            del region_tasks[task.operation]
+        if not region_tasks:
+            del self._queued[task.region]
+        self._queued_size -= 1
+
+    def _pop_task(self):
+        # Lock must be held. Tasks of regions that are not ready yet are parked until they are, still indexed so
+        # requests for them are coalesced, instead of going round the queue
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            task = entry[3]
+            if task is None:
+                continue
+            if self._stages.get(task.region) != Stage.READY:
+                self._parked.setdefault(task.region, []).append(entry)
+                continue
+            self._unindex_task(task)
+            return task
+        return None
 
-    def prioritize_task(self, task, all_regions=False):
-        with self.lock:
+    def put_task(self, task, priority=False):
+        # priority gives the task its old place back (tasks that had to wait), otherwise it goes to the end of its class
+        with self.lock:
+            self._push_task(task, keep_place=priority)
+
+    def get_task_batch(self):
+        # Takes the next task together with the queued tasks of the same region, so processor handles them in one pass
+        with self.lock:
+            first = self._pop_task()
+            if first is None:
+                return []
+            batch = [first]
+            entries = [entry for periods in self._queued.get(first.region, {}).values() for entry in periods.values()]
+            for entry in sorted(entries)[:self._max_batch_size - 1]:
+                batch.append(entry[3])
+                self._remove_entry(entry)
+            return batch
+
+    def request_task(self, task, all_regions=False):
+        # Single flight: a request covered by a queued or running task of the same region and operation (same or
+        # longer period) waits for that task instead of queueing another one. Returns True when it is already processed
+        with self.lock:
+            key = (task.region, task.operation)
+            if self._processed.get(key, 0) >= task.period:
+                return True
             if not all_regions:
-                self._ui_requests.append(task)
-            for idx, queued_task in enumerate(self._queue):
-                if (queued_task.region == task.region and
-                        queued_task.operation == task.operation and
-                        queued_task.period == task.period):
-                    # Remove the task from its current position
-                    del self._queue[idx]
-                    # Add the task to the front of the queue
-                    self._queue.appendleft(task)
-                    return True
-            # If the task is not found, add it to the front of the queue
-            self._queue.appendleft(task)
+                waiting = self._ui_requests.setdefault(key, {})
+                waiting[task.period] = waiting.get(task.period, 0) + 1
+            task.priority = Task.CLUSTER if all_regions else Task.UI
+            if max(self._running.get(key, {}), default=0) >= task.period:
+                return False
+            covering = [period for period in self._queued.get(task.region, {}).get(task.operation, {})
+                        if period >= task.period]
+            if covering:
+                # The covering task moves up to the priority of the request
+                task = Task(task.region, task.operation, min(covering), task.priority)
+            self._push_task(task)
             return False
 
-    def task_has_been_processed(self, task):
-        with self.lock:
-            for item in self._processed_tasks:
-                if (item.region == task.region and
-                        item.operation == task.operation and
-                        item.period >= task.period):
-                    return True
-            return False
+    def start_tasks(self, tasks):
+        # Tasks sent to a processor, requests arriving meanwhile attach to them
+        with self.lock:
+            for task in tasks:
+                running = self._running.setdefault((task.region, task.operation), {})
+                running[task.period] = running.get(task.period, 0) + 1
+
+    def _stop_task(self, task):
+        # Lock must be held
+        key = (task.region, task.operation)
+        running = self._running[key]
+        running[task.period] -= 1
+        if not running[task.period]:
+            del running[task.period]
+        if not running:
+            del self._running[key]
+
+    def requeue_task(self, task):
+        # Running task whose processor is gone, it goes back to its old place in the queue.
+        # Returns False once the task has used up its requeues, it is still running and has to be completed
+        with self.lock:
+            if task.requeues >= self._max_requeues:
+                return False
+            task.requeues += 1
+            self._stop_task(task)
+            self._push_task(task, keep_place=True)
+            return True
+
+    def complete_task(self, task, success):
+        # Returns the periods of UI requests answered by the running task and of those that failed with it.
+        # A failure only fails requests that no other queued or running task covers
+        with self.lock:
+            key = (task.region, task.operation)
+            self._stop_task(task)
+            if success:
+                self._processed[key] = max(self._processed.get(key, 0), task.period)
+                return self._take_waiting(key, 0, self._processed[key]), []
+            covered = max(list(self._running.get(key, {})) +
+                          list(self._queued.get(task.region, {}).get(task.operation, {})), default=0)
+            return [], self._take_waiting(key, covered, task.period)
+
+    def take_answered(self, task):
+        # Periods of UI requests for the region and operation that are covered by what has been processed
+        with self.lock:
+            key = (task.region, task.operation)
+            return self._take_waiting(key, 0, self._processed.get(key, 0))
+
+    def _take_waiting(self, key, above, up_to):
+        # Lock must be held. Removes and returns the requested periods in (above, up_to]
+        waiting = self._ui_requests.get(key, {})
+        periods = sorted(period for period in waiting if above < period <= up_to)
+        for period in periods:
+            del waiting[period]
+        if not waiting:
+            self._ui_requests.pop(key, None)
+        return periods
 
-    def ui_has_requested_task(self, task):
+    def task_has_been_processed(self, task):
         with self.lock:
-            for item in self._ui_requests:
-                if (item.region == task.region and
-                        item.operation == task.operation and
-                        item.period == task.period):
-                    self._ui_requests.remove(item)
-                    return True
-            return False
+            return self._processed.get((task.region, task.operation), 0) >= task.period
@@ -1,25 +1,65 @@
 import pandas as pd
 import matplotlib.pyplot as plt
+from timewindow import TimeWindow
 
 
 class Calculator:
-    @staticmethod
-    def calculate_avg_temp(region, df, months_back):
-        # Convert 'date' column to datetime and filter for the last "months_back" months
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-        latest_date = df['date'].max()
-        max_timestamp = latest_date.timestamp()
+    # Works on frames prepared by the Processor: sorted by time, with date, year, month and integer hour derived once.
+    # The frame is shared with the cache, operations only read from it and work on their own filtered copy.
+
+    # Operations that are plain aggregates per prov/year/month: output column -> (measurement, aggregation)
+    MONTHLY = {
+        "avg_temp": {'avg_temp': ('temp', 'mean')},
+        "pressure_extremes": {'max_pressure': ('stp', 'max'), 'min_pressure': ('stp', 'min')},
+        "humidity_variability": {'humidity_std_dev': ('hmdy', 'std')},
+        "thermal_humidity_index": {'avg_thi': ('thi', 'mean')},
+        "dew_point_range": {'max_dewp': ('dewp', 'max'), 'min_dewp': ('dewp', 'min')},
+        "air_temp_variability": {'temp_std_dev': ('temp', 'std')}
+    }
 
-        # Calculate the cutoff time for the period
-        cutoff_time = max_timestamp - (months_back * 30 * 24 * 3600)  # Approximate calculation
+    @staticmethod
+    def calculate_monthly_batch(region, df, tasks):
+        # Tasks with the same window share one filter and one groupby(['prov', 'year', 'month']) for all aggregates
+        windows = {}
+        for operation, months_back in tasks:
+            start, _ = TimeWindow.rows(df['date'], months_back)
+            windows.setdefault(start, []).append((operation, months_back))
+
+        results = {}
+        for start, window_tasks in windows.items():
+            reg_filtered = df.iloc[start:]
+            aggregations = {}
+            for operation, _ in window_tasks:
+                for name, (column, function) in Calculator.MONTHLY[operation].items():
+                    aggregations[name] = (column, function)
+                    aggregations[f'{column}_count'] = (column, 'count')
+            if 'thi_count' in aggregations:
+                reg_filtered = reg_filtered.assign(thi=0.8 * reg_filtered['temp'] + (
+                        reg_filtered['hmdy'] * (reg_filtered['temp'] - 14.4)) / 100 + 46.4)
+            grouped = reg_filtered.groupby(['prov', 'year', 'month']).agg(**aggregations).reset_index()
+
+            for operation, months_back in window_tasks:
+                outputs = Calculator.MONTHLY[operation]
+                # A month without a single value of the measurement is left out, same as dropna in the operation
+                counts = [f'{column}_count' for column, _ in outputs.values()]
+                result = grouped.loc[(grouped[counts] > 0).all(axis=1), ['prov', 'year', 'month'] + list(outputs)]
+                result = result.reset_index(drop=True)
+                if operation == "dew_point_range":
+                    result['dew_point_range'] = result['max_dewp'] - result['min_dewp']
+                result['period'] = result['year'].astype(str) + result['month'].astype(str).str.zfill(2)
+                result['region'] = region
+                result['date'] = pd.to_datetime(result['period'], format='%Y%m')
+                results[(operation, months_back)] = result.sort_values(by=['prov', 'period'])
+        return results
 
-        # Convert the cutoff time to a datetime object
-        cutoff_date = pd.to_datetime(cutoff_time, unit='s')
+    @staticmethod
+    def calculate_avg_temp(region, df, months_back):
+        # Filter for the last "months_back" calendar months
+        start, stop = TimeWindow.rows(df['date'], months_back)
+        reg_filtered = df.iloc[start:stop]
 
-        # Filter the DataFrame for the last "months_back" months
-        reg_filtered = df[df['date'] >= cutoff_date].copy()
-        reg_filtered['year'] = reg_filtered['date'].dt.year
-        reg_filtered['month'] = reg_filtered['date'].dt.month
+        # Curated data keeps rows with missing measurements, ignore only rows missing what this operation reads
+        reg_filtered = reg_filtered.dropna(subset=['temp']).copy()
 
         # Group by state, year, and month, then calculate average temperature
         avg_temp_by_state = reg_filtered.groupby(['prov', 'year', 'month'])['temp'].mean().reset_index(name='avg_temp')
@@ -41,22 +81,11 @@ class Calculator:
 
     @staticmethod
     def calculate_total_rainfall(region, df, months_back):
-        # Ensure 'hour' and 'prcp' columns are in the correct format
-        df['hour'] = df['hour'].astype(str).str.split(':').str[0].astype(int)
-        df['prcp'] = df['prcp'].astype(float)
-
-        # Convert 'date' column to datetime and filter by 'months_back'
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-        latest_date = df['date'].max()
-
-        # Calculate the cutoff time for the period
-        cutoff_time = latest_date.timestamp() - (months_back * 30 * 24 * 3600)
-        cutoff_date = pd.to_datetime(cutoff_time, unit='s')
-        reg_filtered = df[df['date'] >= cutoff_date].copy()
-
-        # Create 'year' and 'month' columns from 'date'
-        reg_filtered['year'] = reg_filtered['date'].dt.year
-        reg_filtered['month'] = reg_filtered['date'].dt.month
+        # Filter for the last "months_back" calendar months
+        start, stop = TimeWindow.rows(df['date'], months_back)
+        reg_filtered = df.iloc[start:stop]
+        reg_filtered = reg_filtered.dropna(subset=['prcp']).copy()
+        reg_filtered['prcp'] = reg_filtered['prcp'].astype(float)
 
         # Group by 'prov', 'year', 'month', and 'hour', then calculate average 'prcp'
         avg_rainfall_by_hour = reg_filtered.groupby(['prov', 'year', 'month', 'hour'])['prcp'].mean().reset_index()
@@ -81,23 +110,12 @@ class Calculator:
 
     @staticmethod
     def calculate_pressure_extremes(region, df, months_back):
-        # Convert 'date' column to datetime and filter for the last "months_back" months
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-        latest_date = df['date'].max()
-        max_timestamp = latest_date.timestamp()
-
-        # Calculate the cutoff time for the period
-        cutoff_time = max_timestamp - (months_back * 30 * 24 * 3600)  # Approximate calculation
-
-        # Convert the cutoff time to a datetime object
-        cutoff_date = pd.to_datetime(cutoff_time, unit='s')
-
-        # Filter the DataFrame for the last "months_back" months
-        reg_filtered = df[df['date'] >= cutoff_date].copy()
+        # Filter for the last "months_back" calendar months
+        start, stop = TimeWindow.rows(df['date'], months_back)
+        reg_filtered = df.iloc[start:stop]
+        reg_filtered = reg_filtered.dropna(subset=['stp']).copy()
 
         # Group by state and month, then calculate highest and lowest pressures
-        reg_filtered['year'] = reg_filtered['date'].dt.year
-        reg_filtered['month'] = reg_filtered['date'].dt.month
         pressure_extremes = reg_filtered.groupby(['prov', 'year', 'month']).agg(
             max_pressure=('stp', 'max'),
             min_pressure=('stp', 'min')
@@ -120,15 +138,12 @@ class Calculator:
 
     @staticmethod
     def calculate_wind_speed(region, df, months_back):
-        # Convert 'date' column to datetime and filter for the last "months_back" months
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-        latest_date = df['date'].max()
-        cutoff_date = latest_date - pd.DateOffset(months=months_back)
-        reg_filtered = df[df['date'] > cutoff_date].copy()
+        # Filter for the last "months_back" calendar months
+        start, stop = TimeWindow.rows(df['date'], months_back)
+        reg_filtered = df.iloc[start:stop]
+        reg_filtered = reg_filtered.dropna(subset=['wdsp']).copy()
 
         # Group by state, year, and month, then calculate average wind speed
-        reg_filtered['year'] = reg_filtered['date'].dt.year
-        reg_filtered['month'] = reg_filtered['date'].dt.month
         avg_wind_speed = reg_filtered.groupby(['prov', 'year', 'month'])['wdsp'].mean().reset_index(
             name='avg_wind_speed')
 
@@ -160,15 +175,12 @@ class Calculator:
 
     @staticmethod
     def calculate_total_solar_radiation(region, df, months_back):
-        # Convert 'date' column to datetime and filter for the last "months_back" months
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-        latest_date = df['date'].max()
-        cutoff_date = latest_date - pd.DateOffset(months=months_back)
-        reg_filtered = df[df['date'] > cutoff_date].copy()
+        # Filter for the last "months_back" calendar months
+        start, stop = TimeWindow.rows(df['date'], months_back)
+        reg_filtered = df.iloc[start:stop]
+        reg_filtered = reg_filtered.dropna(subset=['gbrd']).copy()
 
         # Group by province, year, and month, then calculate the sum of solar radiation
-        reg_filtered['year'] = reg_filtered['date'].dt.year
-        reg_filtered['month'] = reg_filtered['date'].dt.month
         daily_solar_radiation = reg_filtered.groupby(['prov', 'date'])['gbrd'].mean().reset_index(
             name='daily_solar_radiation')
 
@@ -176,14 +188,15 @@ class Calculator:
         avg_daily_solar_radiation = daily_solar_radiation.groupby(['prov'])['daily_solar_radiation'].mean().reset_index(
             name='avg_daily_solar_radiation')
 
-        # Merge with the original dataframe to distribute the average daily radiation back to each row
-        monthly_data = pd.merge(reg_filtered, avg_daily_solar_radiation, on='prov')
-
-        # Calculate the total monthly solar radiation per province
-        monthly_data['total_solar_radiation'] = monthly_data['avg_daily_solar_radiation'] * monthly_data[
-            'date'].dt.daysinmonth
-        monthly_solar_radiation = monthly_data.groupby(['prov', 'year', 'month'])[
-            'total_solar_radiation'].sum().reset_index()
+        # Every reading of a month contributes the province average times the days of that month, so the monthly
+        # total is the average times the number of readings and days, no need to broadcast it back to the rows
+        monthly_solar_radiation = reg_filtered.groupby(['prov', 'year', 'month']).size().reset_index(name='readings')
+        days_in_month = pd.to_datetime(monthly_solar_radiation['year'].astype(str) + '-' +
+                                       monthly_solar_radiation['month'].astype(str)).dt.daysinmonth
+        average = monthly_solar_radiation['prov'].map(
+            avg_daily_solar_radiation.set_index('prov')['avg_daily_solar_radiation'])
+        monthly_solar_radiation['total_solar_radiation'] = average * monthly_solar_radiation['readings'] * days_in_month
+        monthly_solar_radiation = monthly_solar_radiation.drop(columns='readings')
 
         # Add period column
         monthly_solar_radiation['period'] = monthly_solar_radiation['year'].astype(str) + monthly_solar_radiation[
@@ -202,26 +215,14 @@ class Calculator:
 
     @staticmethod
     def calculate_wind_direction_distribution(region, df, months_back):
-        # Convert the 'date' column from string to datetime object
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-
-        # Find the latest date in the dataset for the cutoff calculation
-        latest_date = df['date'].max()
-        cutoff_time = latest_date.timestamp() - (months_back * 30 * 24 * 3600)
-
-        # Convert the cutoff timestamp back to a datetime object
-        cutoff_date = pd.to_datetime(cutoff_time, unit='s')
-
-        # Filter the DataFrame to only include data after the cutoff date
-        reg_filtered = df[df['date'] >= cutoff_date].copy()
+        # Filter for the last "months_back" calendar months
+        start, stop = TimeWindow.rows(df['date'], months_back)
+        reg_filtered = df.iloc[start:stop]
+        reg_filtered = reg_filtered.dropna(subset=['wdct']).copy()
 
         # Replace instances of 360 degrees with 0 for wind direction
         reg_filtered['wdct'] = reg_filtered['wdct'].replace(360, 0)
 
-        # Extract the year and month from the 'date' column
-        reg_filtered['year'] = reg_filtered['date'].dt.year
-        reg_filtered['month'] = reg_filtered['date'].dt.month
-
         # Define ranges for wind direction categories
         direction_ranges = [(0, 90), (91, 180), (181, 270), (271, 359)]
         direction_labels = ['N', 'E', 'S', 'W']
@@ -256,14 +257,11 @@ class Calculator:
 
     @staticmethod
     def calculate_humidity_variability(region, df, months_back):
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-        latest_date = df['date'].max()
-        cutoff_time = latest_date.timestamp() - (months_back * 30 * 24 * 3600)
-        cutoff_date = pd.to_datetime(cutoff_time, unit='s')
-        reg_filtered = df[df['date'] >= cutoff_date].copy()
-
-        reg_filtered['year'] = reg_filtered['date'].dt.year
-        reg_filtered['month'] = reg_filtered['date'].dt.month
+        # Filter for the last "months_back" calendar months
+        start, stop = TimeWindow.rows(df['date'], months_back)
+        reg_filtered = df.iloc[start:stop]
+        reg_filtered = reg_filtered.dropna(subset=['hmdy']).copy()
+
         humidity_variability = reg_filtered.groupby(['prov', 'year', 'month'])['hmdy'].std().reset_index(
             name='humidity_std_dev')
 
@@ -278,18 +276,15 @@ class Calculator:
 
     @staticmethod
     def calculate_thi(region, df, months_back):
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-        latest_date = df['date'].max()
-        cutoff_time = latest_date.timestamp() - (months_back * 30 * 24 * 3600)
-        cutoff_date = pd.to_datetime(cutoff_time, unit='s')
-        reg_filtered = df[df['date'] >= cutoff_date].copy()
+        # Filter for the last "months_back" calendar months
+        start, stop = TimeWindow.rows(df['date'], months_back)
+        reg_filtered = df.iloc[start:stop]
+        reg_filtered = reg_filtered.dropna(subset=['temp', 'hmdy']).copy()
 
         # Calculate THI using the formula: THI = 0.8 * temp + (hmdy * (temp - 14.4)) / 100 + 46.4
         reg_filtered['thi'] = 0.8 * reg_filtered['temp'] + (
                 reg_filtered['hmdy'] * (reg_filtered['temp'] - 14.4)) / 100 + 46.4
 
-        reg_filtered['year'] = reg_filtered['date'].dt.year
-        reg_filtered['month'] = reg_filtered['date'].dt.month
         thi_data = reg_filtered.groupby(['prov', 'year', 'month'])['thi'].mean().reset_index(name='avg_thi')
 
         thi_data['period'] = thi_data['year'].astype(str) + thi_data['month'].astype(str).str.zfill(2)
@@ -301,14 +296,11 @@ class Calculator:
 
     @staticmethod
     def calculate_dew_point_range(region, df, months_back):
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-        latest_date = df['date'].max()
-        cutoff_time = latest_date.timestamp() - (months_back * 30 * 24 * 3600)
-        cutoff_date = pd.to_datetime(cutoff_time, unit='s')
-        reg_filtered = df[df['date'] >= cutoff_date].copy()
-
-        reg_filtered['year'] = reg_filtered['date'].dt.year
-        reg_filtered['month'] = reg_filtered['date'].dt.month
+        # Filter for the last "months_back" calendar months
+        start, stop = TimeWindow.rows(df['date'], months_back)
+        reg_filtered = df.iloc[start:stop]
+        reg_filtered = reg_filtered.dropna(subset=['dewp']).copy()
+
         dew_point_range = reg_filtered.groupby(['prov', 'year', 'month']).agg(
             max_dewp=('dewp', 'max'),
             min_dewp=('dewp', 'min')
@@ -332,13 +324,11 @@ class Calculator:
 
     @staticmethod
     def calculate_air_temp_variability(region, df, months_back):
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-        latest_date = df['date'].max()
-        cutoff_date = latest_date - pd.DateOffset(months=months_back)
-        reg_filtered = df[df['date'] > cutoff_date].copy()
+        # Filter for the last "months_back" calendar months
+        start, stop = TimeWindow.rows(df['date'], months_back)
+        reg_filtered = df.iloc[start:stop]
+        reg_filtered = reg_filtered.dropna(subset=['temp']).copy()
 
-        reg_filtered['year'] = reg_filtered['date'].dt.year
-        reg_filtered['month'] = reg_filtered['date'].dt.month
         temp_variability = reg_filtered.groupby(['prov', 'year', 'month']).agg(
             temp_std_dev=('temp', 'std')
         ).reset_index()
@@ -2,17 +2,18 @@ from paho.mqtt.client import Client
 
 
 class Comm:
-    def __init__(self, broker_address, request_topic, response_topic):
+    def __init__(self, instance, broker_address, request_topics, response_topic):
+        self.instance = instance
         self.broker_address = broker_address
-        self.request_topic = request_topic
+        self.request_topics = request_topics
         self.response_topic = response_topic
-        self.client = Client(client_id="processor")
+        self.client = Client(client_id=instance)
         self.client.on_message = self.on_message
         self.callback = None
 
     def on_message(self, client, userdata, message):
         payload = str(message.payload.decode('utf-8'))
-        print(f"Processor: Received request: {payload}")
+        print(f"Processor {self.instance}: Received request: {payload}")
 
         if self.callback:
             response = self.callback(payload)
@@ -20,12 +21,13 @@ class Comm:
                 self.client.publish(self.response_topic, response)
 
     def send_info(self, message):
-        self.client.publish("info", "Processor: " + str(message))
+        self.client.publish("info", f"Processor {self.instance}: " + str(message))
 
     def start(self, callback):
         self.callback = callback
         self.client.connect(self.broker_address)
-        self.client.subscribe(self.request_topic)
+        for topic in self.request_topics:
+            self.client.subscribe(topic)
         self.client.loop_start()
 
     def stop(self):
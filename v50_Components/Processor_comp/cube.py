@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+from timewindow import TimeWindow
+
+
+class Cube:
+    def __init__(self, region, daily, hourly):
+        # Per prov/day (and prov/day/hour for rainfall) partial states built by the Transformer, sorted by date
+        self.region = region
+        self.daily = daily
+        self.hourly = hourly
+        self.latest_date = daily['date'].max()
+        self.size = int(daily.memory_usage(deep=True).sum() + hourly.memory_usage(deep=True).sum())
+        self.operations = {
+            "avg_temp": self.avg_temp,
+            "total_rainfall": self.total_rainfall,
+            "pressure_extremes": self.pressure_extremes,
+            "wind_speed": self.wind_speed,
+            "solar_radiation": self.solar_radiation,
+            "wind_direction_distribution": self.wind_direction_distribution,
+            "humidity_variability": self.humidity_variability,
+            "thermal_humidity_index": self.thi,
+            "dew_point_range": self.dew_point_range,
+            "air_temp_variability": self.air_temp_variability
+        }
+
+    def calculate(self, operation, months_back):
+        return self.operations[operation](months_back)
+
+    def window(self, frame, months_back):
+        # Same calendar month window as Calculator, cut with a binary search on the sorted dates
+        start = frame['date'].searchsorted(TimeWindow.start(self.latest_date, months_back), side='left')
+        return frame.iloc[start:]
+
+    @staticmethod
+    def monthly(frame, measure, states):
+        # Rolls day states up to prov/year/month, months without a single value of the measure are left out
+        frame = frame[frame[f'{measure}_count'] > 0]
+        grouped = frame.groupby(['prov', frame['date'].dt.year.rename('year'), frame['date'].dt.month.rename('month')])
+        aggregations = {state: 'min' if state.endswith('_min') else 'max' if state.endswith('_max') else 'sum'
+                        for state in states}
+        return grouped.agg(aggregations).reset_index()
+
+    def finish(self, result, name, values):
+        return self.label(result[['prov', 'year', 'month']].assign(**{name: values}))
+
+    def label(self, result):
+        # Same trailing columns and order as the Calculator results
+        period = result['year'].astype(str) + result['month'].astype(str).str.zfill(2)
+        result = result.assign(period=period, region=self.region, date=pd.to_datetime(period, format='%Y%m'))
+        return result.sort_values(by=['prov', 'period'])
+
+    @staticmethod
+    def std(count, total, total_sq):
+        # Sample standard deviation (ddof=1) from count, sum and sum of squares, NaN for a single value like pandas
+        variance = (total_sq - total * total / count) / (count - 1)
+        return np.sqrt(variance.clip(lower=0)).where(count > 1)
+
+    def avg_temp(self, months_back):
+        result = self.monthly(self.window(self.daily, months_back), 'temp', ['temp_count', 'temp_sum'])
+        return self.finish(result, 'avg_temp', result['temp_sum'] / result['temp_count'])
+
+    def total_rainfall(self, months_back):
+        hourly = self.window(self.hourly, months_back)
+        hourly = hourly[hourly['prcp_count'] > 0]
+        by_hour = hourly.groupby(['prov', hourly['date'].dt.year.rename('year'),
+                                  hourly['date'].dt.month.rename('month'), 'hour'])[['prcp_count', 'prcp_sum']].sum()
+        by_hour['prcp'] = by_hour['prcp_sum'] / by_hour['prcp_count']
+        result = by_hour.groupby(['prov', 'year', 'month'])['prcp'].sum().reset_index(name='total_rainfall')
+        return self.label(result)
+
+    def pressure_extremes(self, months_back):
+        result = self.monthly(self.window(self.daily, months_back), 'stp', ['stp_count', 'stp_max', 'stp_min'])
+        result = result.rename(columns={'stp_max': 'max_pressure', 'stp_min': 'min_pressure'})
+        return self.label(result[['prov', 'year', 'month', 'max_pressure', 'min_pressure']])
+
+    def wind_speed(self, months_back):
+        result = self.monthly(self.window(self.daily, months_back), 'wdsp', ['wdsp_count', 'wdsp_sum'])
+        result['avg_wind_speed'] = result['wdsp_sum'] / result['wdsp_count']
+        # Mean deviation from the monthly mean is zero by definition
+        result['avg_wind_speed_deviation'] = 0.0
+        return self.label(result[['prov', 'year', 'month', 'avg_wind_speed', 'avg_wind_speed_deviation']])
+
+    def solar_radiation(self, months_back):
+        daily = self.window(self.daily, months_back)
+        daily = daily[daily['gbrd_count'] > 0]
+        # Average of the daily means per prov, times the number of readings and days of each month
+        average = (daily['gbrd_sum'] / daily['gbrd_count']).groupby(daily['prov']).mean()
+        result = self.monthly(daily, 'gbrd', ['gbrd_count'])
+        days = pd.to_datetime(result['year'].astype(str) + '-' + result['month'].astype(str)).dt.daysinmonth
+        return self.finish(result, 'total_solar_radiation',
+                           result['prov'].map(average) * result['gbrd_count'] * days)
+
+    def wind_direction_distribution(self, months_back):
+        labels = ['N', 'E', 'S', 'W']
+        result = self.monthly(self.window(self.daily, months_back), 'wdct',
+                              ['wdct_count'] + [f'wdct_{label}_sum' for label in labels])
+        result = result.rename(columns={f'wdct_{label}_sum': label for label in labels})
+        result = self.label(result[['prov', 'year', 'month'] + labels])
+        # Months missing any direction are left out, same as Calculator
+        return result.loc[~(result[labels] == 0).any(axis=1)]
+
+    def humidity_variability(self, months_back):
+        result = self.monthly(self.window(self.daily, months_back), 'hmdy', ['hmdy_count', 'hmdy_sum', 'hmdy_sumsq'])
+        return self.finish(result, 'humidity_std_dev',
+                           self.std(result['hmdy_count'], result['hmdy_sum'], result['hmdy_sumsq']))
+
+    def thi(self, months_back):
+        result = self.monthly(self.window(self.daily, months_back), 'thi', ['thi_count', 'thi_sum'])
+        return self.finish(result, 'avg_thi', result['thi_sum'] / result['thi_count'])
+
+    def dew_point_range(self, months_back):
+        result = self.monthly(self.window(self.daily, months_back), 'dewp', ['dewp_count', 'dewp_max', 'dewp_min'])
+        result = result.rename(columns={'dewp_max': 'max_dewp', 'dewp_min': 'min_dewp'})
+        result['dew_point_range'] = result['max_dewp'] - result['min_dewp']
+        return self.label(result[['prov', 'year', 'month', 'max_dewp', 'min_dewp', 'dew_point_range']])
+
+    def air_temp_variability(self, months_back):
+        result = self.monthly(self.window(self.daily, months_back), 'temp',
+                              ['temp_count', 'temp_sum', 'temp_sumsq'])
+        return self.finish(result, 'temp_std_dev',
+                           self.std(result['temp_count'], result['temp_sum'], result['temp_sumsq']))
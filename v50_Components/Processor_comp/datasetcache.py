@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+
+class Dataset:
+    def __init__(self, region, data, months_loaded, columns):
+        self.region = region
+        self.data = data
+        # Only the latest months_loaded months and the measurement columns requested so far are loaded
+        self.months_loaded = months_loaded
+        self.columns = frozenset(columns)
+        self.size = int(data.memory_usage(deep=True).sum())
+
+    def covers(self, months_back, columns):
+        return self.months_loaded >= months_back and self.columns.issuperset(columns)
+
+
+class DatasetCache:
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.lock = threading.Lock()
+        self.datasets = OrderedDict()
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, region, months_back, columns):
+        with self.lock:
+            dataset = self.datasets.get(region)
+            if dataset is None or not dataset.covers(months_back, columns):
+                self.misses += 1
+                return None
+            self.datasets.move_to_end(region)
+            self.hits += 1
+            return dataset
+
+    def peek(self, region):
+        with self.lock:
+            return self.datasets.get(region)
+
+    def put(self, dataset):
+        with self.lock:
+            self.discard(dataset.region)
+            self.datasets[dataset.region] = dataset
+            self.memory_used += dataset.size
+            # Least recently used regions go first, the newest one stays even if it alone exceeds the budget
+            while self.memory_used > self.memory_budget and len(self.datasets) > 1:
+                _, evicted = self.datasets.popitem(last=False)
+                self.memory_used -= evicted.size
+                self.evictions += 1
+
+    def regions(self):
+        with self.lock:
+            return list(self.datasets)
+
+    def invalidate(self, region):
+        with self.lock:
+            return self.discard(region)
+
+    def discard(self, region):
+        dataset = self.datasets.pop(region, None)
+        if dataset is None:
+            return False
+        self.memory_used -= dataset.size
+        return True
+
+    def stats(self):
+        with self.lock:
+            return (f"regions={list(self.datasets)}, memory={self.memory_used // (1024 * 1024)}MB/"
+                    f"{self.memory_budget // (1024 * 1024)}MB, hits={self.hits}, misses={self.misses}, "
+                    f"evictions={self.evictions}")
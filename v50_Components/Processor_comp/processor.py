@@ -1,37 +1,322 @@
+import json
 import os
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
+import socket
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from comm import Comm
 from calculator import Calculator
+from cube import Cube
+from datasetcache import Dataset, DatasetCache
+from hdfsfile import HdfsFile
+from resultcache import ResultCache
+from resultcodec import ResultCodec
+from streaming import StreamingCalculator
+from timewindow import TimeWindow
 from hdfs import InsecureClient
 
 
 class Processor:
-    def __init__(self, hdfs_host, hdfs_port, hdfs_user):
+    def __init__(self, hdfs_host, hdfs_port, hdfs_user, configuration):
         self.hdfs_client = InsecureClient(f"{hdfs_host}:{hdfs_port}", user=hdfs_user)
         self.shutdown_event = threading.Event()
-        self.comm = Comm("mqtt-broker", "processor", "response")
-        self.region = None
-        self.data = None
+        # Every instance listens on the shared processor topic (invalidate, shutdown) and on its own topic, where
+        # Marshaller sends the calculations routed to it
+        self.instance = os.environ.get("PROCESSOR_ID") or socket.gethostname()
+        self.comm = Comm(self.instance, "mqtt-broker", ["processor", f"processor/{self.instance}"], "response")
+        # Operation -> (calculation, measurement columns it reads), every operation also needs timestamp and prov
+        self.calculations = {
+            "avg_temp": (Calculator.calculate_avg_temp, ['temp']),
+            "total_rainfall": (Calculator.calculate_total_rainfall, ['prcp']),
+            "pressure_extremes": (Calculator.calculate_pressure_extremes, ['stp']),
+            "wind_speed": (Calculator.calculate_wind_speed, ['wdsp']),
+            "solar_radiation": (Calculator.calculate_total_solar_radiation, ['gbrd']),
+            "wind_direction_distribution": (Calculator.calculate_wind_direction_distribution, ['wdct']),
+            "humidity_variability": (Calculator.calculate_humidity_variability, ['hmdy']),
+            "thermal_humidity_index": (Calculator.calculate_thi, ['temp', 'hmdy']),
+            "dew_point_range": (Calculator.calculate_dew_point_range, ['dewp']),
+            "air_temp_variability": (Calculator.calculate_air_temp_variability, ['temp'])
+        }
 
-    def check_read_parquet_from_hdfs(self, region):
-        if region == self.region:
-            return True
+        with open(configuration, 'r') as file:
+            config_data = json.load(file)
+            self.partitioned = bool(config_data["partitioned"])
+            self.cache = DatasetCache(int(config_data["cache_memory_mb"]) * 1024 * 1024)
+            # Answer operations from the aggregated cube when one exists for the current curated data
+            self.use_cube = bool(config_data["use_cube"])
+            # frame keeps regions in memory for repeated requests, streaming bounds memory by the batch size
+            self.engine = config_data["engine"]
+            self.batch_size = int(config_data["batch_size"])
+            # Solar radiation uses the province average over the whole window, so it is never cut from a longer period
+            self.results = ResultCache(int(config_data["result_cache_mb"]) * 1024 * 1024, ["solar_radiation"])
+            # Calculations run on a pool so the MQTT loop keeps answering alive and shutdown while they are busy
+            self.max_workers = int(config_data["max_workers"])
+            self.announce_interval = int(config_data["announce_interval"])
+            # arrow sends results as Arrow IPC with a small header (resultcodec.py), json as operation:json
+            self.result_format = config_data["result_format"]
+            self.result_compression = config_data["result_compression"]
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="calculation")
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        # One load per region at a time, so jobs on the same region share loads instead of repeating them.
+        # Calculations run outside of it, a slow operation does not hold up the others of the region
+        self.region_locks = {}
+        self.cubes = {}
+        # Bumped whenever a region is curated again, results of older versions are never served
+        self.versions = {}
+
+    def region_lock(self, region):
+        with self.lock:
+            return self.region_locks.setdefault(region, threading.Lock())
+
+    def version(self, region):
+        with self.lock:
+            return self.versions.get(region, 0)
+
+    def submit(self, job, *args):
+        with self.lock:
+            self.queued += 1
+        self.pool.submit(self.run_job, job, *args)
+
+    def run_job(self, job, *args):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            # Jobs still queued at shutdown are dropped
+            if self.shutdown_event.is_set():
+                return
+            response = job(*args)
+        except Exception as e:
+            self.comm.send_info(f"Calculation failed: {e}")
+            # Marshaller is answered right away instead of waiting for its timeout
+            response = self.failure_response(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+        self.comm.client.publish(self.comm.response_topic, response)
+
+    def announce(self):
+        # instance:jobs:warm regions on processor_status, Marshaller routes regions to instances that hold them
+        while not self.shutdown_event.is_set():
+            with self.lock:
+                jobs = self.running + self.queued
+            warm = sorted(set(self.cache.regions()) | set(self.cubes))
+            self.comm.client.publish("processor_status", f"{self.instance}:{jobs}:{','.join(warm)}")
+            self.shutdown_event.wait(self.announce_interval)
+
+    def job_stats(self):
+        with self.lock:
+            return f"workers={self.max_workers}, running={self.running}, queued={self.queued}"
+
+    def open_parquet(self, hdfs_path):
+        # Only the footer is fetched here, column chunks are read later by offset/length
+        return pq.ParquetFile(HdfsFile(self.hdfs_client, hdfs_path), pre_buffer=True)
+
+    @staticmethod
+    def timestamp_range(parquet_file, row_group):
+        column = parquet_file.schema_arrow.get_field_index('timestamp')
+        statistics = parquet_file.metadata.row_group(row_group).column(column).statistics
+        if statistics is None or not statistics.has_min_max:
+            return None
+        return pd.Timestamp(statistics.min), pd.Timestamp(statistics.max)
+
+    def plan_window(self, paths, months_back):
+        # Returns the newest day, the window start and the row groups per file that reach into the window
+        files = [self.open_parquet(path) for path in paths]
+        ranges = [[self.timestamp_range(file, index) for index in range(file.metadata.num_row_groups)]
+                  for file in files]
+        if all(row_range is not None for file_ranges in ranges for row_range in file_ranges):
+            latest = max((row_range[1] for file_ranges in ranges for row_range in file_ranges), default=None)
+        else:
+            # Without footer statistics only the timestamp column is read to find the newest day
+            maxima = [pc.max(file.read(columns=['timestamp'])['timestamp']).as_py() for file in files]
+            latest = max((pd.Timestamp(value) for value in maxima if value is not None), default=None)
+        if latest is None:
+            return None, None, []
+        latest = latest.normalize()
+        cutoff = TimeWindow.start(latest, months_back)
+        plan = []
+        for file, file_ranges in zip(files, ranges):
+            row_groups = [index for index, row_range in enumerate(file_ranges)
+                          if row_range is None or row_range[1] >= cutoff]
+            if row_groups:
+                plan.append((file, row_groups))
+        return latest, cutoff, plan
+
+    @staticmethod
+    def in_window(table, cutoff):
+        return table.filter(pc.greater_equal(table['timestamp'],
+                                             pa.scalar(cutoff.to_pydatetime(), table.schema.field('timestamp').type)))
+
+    def read_window(self, paths, months_back, columns):
+        _, cutoff, plan = self.plan_window(paths, months_back)
+        if not plan:
+            raise ValueError("no data in the requested window")
+        table = pa.concat_tables([file.read_row_groups(row_groups, columns=columns) for file, row_groups in plan])
+        return self.in_window(table, cutoff)
+
+    def stream_window(self, region, tasks):
+        # Record batches are turned into partial states one by one, only one batch of rows is in memory at a time.
+        # All tasks of the region are fed from the same pass over the data
+        months_back = max(period for _, period in tasks)
+        if self.partitioned:
+            paths = self.list_partitions(region, months_back)
+        else:
+            paths = [f"/datalake/curated/{region}.parquet"]
+        latest, cutoff, plan = self.plan_window(paths, months_back)
+        if latest is None:
+            raise ValueError(f"no data for {region}")
+        calculators = [StreamingCalculator(region, calculation, period, latest) for calculation, period in tasks]
+        columns = ['timestamp', 'prov'] + sorted({column for calculation, _ in tasks
+                                                  for column in self.calculations[calculation][1]})
+        for file, row_groups in plan:
+            for batch in file.iter_batches(batch_size=self.batch_size, row_groups=row_groups, columns=columns):
+                frame = self.to_frame(self.in_window(pa.Table.from_batches([batch]), cutoff))
+                for calculator in calculators:
+                    calculator.consume(frame)
+        return latest, {task: calculator.result() for task, calculator in zip(tasks, calculators)}
+
+    def calculate(self, region, tasks):
+        # Returns the result frame for every (calculation, period) task of the region, None when it failed.
+        # Results already computed for the same or a longer period are served from the result cache
+        version = self.version(region)
+        results = {task: self.results.get(task[0], region, version, task[1]) for task in tasks}
+        missing = [task for task, result in results.items() if result is None]
+        if missing:
+            latest_date, computed = self.compute(region, missing, version)
+            for task, result in computed.items():
+                results[task] = result
+                if result is not None:
+                    self.results.put(task[0], region, version, task[1], latest_date, result)
+        return results
+
+    def compute(self, region, tasks, version):
+        # Returns the newest data date the windows were cut from, the result cache slices shorter periods from it
+        with self.region_lock(region):
+            cube = self.read_cube(region, version) if self.use_cube else None
+        if cube is not None:
+            return cube.latest_date, {(calculation, period): cube.calculate(calculation, period)
+                                      for calculation, period in tasks}
+        if self.engine == "streaming":
+            try:
+                # Streaming reads while it calculates, nothing is kept for the next job
+                with self.region_lock(region):
+                    return self.stream_window(region, tasks)
+            except Exception as e:
+                self.comm.send_info(f"Failed to process data for {region}: {e}")
+                return None, {task: None for task in tasks}
+        columns = {column for calculation, _ in tasks for column in self.calculations[calculation][1]}
+        with self.region_lock(region):
+            data = self.read_dataset(region, max(period for _, period in tasks), columns, version)
+        if data is None:
+            return None, {task: None for task in tasks}
+        monthly = [task for task in tasks if task[0] in Calculator.MONTHLY]
+        shared = Calculator.calculate_monthly_batch(region, data, monthly) if monthly else {}
+        latest_date = data['date'].iloc[-1] if len(data) else None
+        results = {(calculation, period): shared[(calculation, period)] if (calculation, period) in shared
+                   else self.calculations[calculation][0](region, data, period) for calculation, period in tasks}
+        return latest_date, results
+
+    def publish_results(self, region, results):
+        for (calculation, period), result in results.items():
+            if result is None:
+                continue
+            self.comm.send_info(f"Successfully finished processing:{calculation} for {region} duration: {period}")
+            self.comm.send_info(f"Sending result to DAO: {calculation} for {region} for {period}")
+            if self.result_format == "arrow":
+                payload = ResultCodec.encode(calculation, region, period, result, self.result_compression)
+            else:
+                payload = f"{calculation}:{result.to_json()}"
+            self.comm.client.publish("database", payload)
+
+    @staticmethod
+    def to_frame(table):
+        # Station fields are dictionary encoded in storage, Calculator groups on them as plain strings
+        for index, field in enumerate(table.schema):
+            if pa.types.is_dictionary(field.type):
+                table = table.set_column(index, field.name, pc.cast(table.column(index), pa.string()))
+        df = table.to_pandas()
+        # Date and hour are stored as a single timestamp, derived once here so Calculator never parses or mutates them
+        df['date'] = df['timestamp'].dt.normalize()
+        df['year'] = df['timestamp'].dt.year
+        df['month'] = df['timestamp'].dt.month
+        df['hour'] = df['timestamp'].dt.hour
+        return df
+
+    def list_partitions(self, region, months_back):
+        # Walks prov=../year=../month=.. and keeps the months that can fall into the requested window
+        root = f"/datalake/curated/{region}"
+        partitions = []
+        for directory, _, files in self.hdfs_client.walk(root, depth=3):
+            keys = dict(part.split("=", 1) for part in directory[len(root) + 1:].split("/") if "=" in part)
+            if files and keys.get('year', '').isdigit() and keys.get('month', '').isdigit():
+                partitions.append((int(keys['year']) * 12 + int(keys['month']) - 1, directory, files))
+        if not partitions:
+            return []
+        latest_month = max(month for month, _, _ in partitions)
+        return [f"{directory}/{file}" for month, directory, files in partitions
+                if month > latest_month - months_back for file in files if not file.startswith('_')]
+
+    def read_dataset(self, region, months_back, columns, version):
+        dataset = self.cache.get(region, months_back, columns)
+        if dataset is not None:
+            return dataset.data
+        # Widen what is already cached instead of replacing it, so the next operation on the region is a hit
+        cached = self.cache.peek(region)
+        if cached is not None:
+            months_back = max(months_back, cached.months_loaded)
+            columns = columns | cached.columns
         self.comm.send_info(f"Reading data for: {region}")
-        hdfs_path = f"/datalake/curated/{region}.parquet"
         try:
-            with self.hdfs_client.read(hdfs_path) as reader:
-                data = reader.read()
-                self.data = pq.read_table(pa.BufferReader(data)).to_pandas()
-                self.comm.send_info(f"Data for {region} loaded successfully.")
-                self.region = region
-                return True
+            if self.partitioned:
+                paths = self.list_partitions(region, months_back)
+            else:
+                paths = [f"/datalake/curated/{region}.parquet"]
+            table = self.read_window(paths, months_back, ['timestamp', 'prov'] + sorted(columns))
+            # Sorted by time so Calculator cuts windows with a binary search
+            dataset = Dataset(region, self.to_frame(table.sort_by('timestamp')), months_back, columns)
+            # Region invalidated while it was being read, the data is used for this request only
+            if self.version(region) == version:
+                self.cache.put(dataset)
+            self.comm.send_info(f"Data for {region} loaded successfully. Cache: {self.cache.stats()}")
+            return dataset.data
         except Exception as e:
             self.comm.send_info(f"Failed to load data for {region}: {e}")
-            self.data[region] = None
-            return False
+            return None
+
+    def read_manifest(self, manifest_path):
+        if self.hdfs_client.status(manifest_path, strict=False) is None:
+            return None
+        with self.hdfs_client.read(manifest_path, encoding='utf-8') as reader:
+            return json.load(reader)
+
+    def read_cube(self, region, version):
+        if region in self.cubes:
+            return self.cubes[region]
+        if self.partitioned:
+            curated_manifest = self.read_manifest(f"/datalake/curated/{region}/_manifest.json")
+        else:
+            curated_manifest = self.read_manifest(f"/datalake/curated/{region}.manifest.json")
+        manifest = self.read_manifest(f"/datalake/aggregated/{region}/_manifest.json")
+        # A cube built from an older curated version would give stale results, raw data is used until it is rebuilt
+        if curated_manifest is None or manifest is None or manifest["curated"] != curated_manifest:
+            return None
+        try:
+            daily = self.open_parquet(f"/datalake/aggregated/{region}/daily.parquet").read().to_pandas()
+            hourly = self.open_parquet(f"/datalake/aggregated/{region}/hourly.parquet").read().to_pandas()
+        except Exception as e:
+            self.comm.send_info(f"Failed to load aggregated data for {region}: {e}")
+            return None
+        cube = Cube(region, daily, hourly)
+        if self.version(region) == version:
+            self.cubes[region] = cube
+        self.comm.send_info(f"Aggregated data for {region} loaded ({cube.size // 1024}KB).")
+        return cube
 
     def handle_request(self, payload):
         parts = payload.split(":")
@@ -42,46 +327,67 @@ class Processor:
                 self.shutdown_event.set()
                 return f"{request_id}:processor:{command}:acknowledged"
             elif command == "alive" and item == "request":
-                self.comm.send_info("Alive => Running...")
+                self.comm.send_info(f"Alive => Running... Jobs: {self.job_stats()} Cache: {self.cache.stats()} "
+                                    f"Results: {self.results.stats()}")
                 return f"{request_id}:processor:alive:waiting"
+            elif command == "invalidate":
+                # Region has been curated again, cached data for it is stale
+                with self.lock:
+                    self.versions[item] = self.versions.get(item, 0) + 1
+                self.cubes.pop(item, None)
+                self.results.invalidate(item)
+                if self.cache.invalidate(item):
+                    self.comm.send_info(f"Dropped cached data for {item}.")
+                return f"{request_id}:{command}:{item}:success"
             else:
                 self.comm.send_info(f"Unknown command: {command}")
                 return f"{request_id}:{command}:{item}:error"
+        if len(parts) == 4 and parts[1] == "batch":
+            self.submit(self.handle_batch, *parts)
+            return None
         if len(parts) == 4:
-            request_id, calculation, region, period = parts
-            if calculation == "avg_temp" and self.check_read_parquet_from_hdfs(region):
-                result = Calculator.calculate_avg_temp(region, self.data, int(period))
-            elif calculation == "total_rainfall" and self.check_read_parquet_from_hdfs(region):
-                result = Calculator.calculate_total_rainfall(region, self.data, int(period))
-            elif calculation == "pressure_extremes" and self.check_read_parquet_from_hdfs(region):
-                result = Calculator.calculate_pressure_extremes(region, self.data, int(period))
-            elif calculation == "wind_speed" and self.check_read_parquet_from_hdfs(region):
-                result = Calculator.calculate_wind_speed(region, self.data, int(period))
-            elif calculation == "solar_radiation" and self.check_read_parquet_from_hdfs(region):
-                result = Calculator.calculate_total_solar_radiation(region, self.data, int(period))
-            elif calculation == "wind_direction_distribution" and self.check_read_parquet_from_hdfs(region):
-                result = Calculator.calculate_wind_direction_distribution(region, self.data, int(period))
-            elif calculation == "humidity_variability" and self.check_read_parquet_from_hdfs(region):
-                result = Calculator.calculate_humidity_variability(region, self.data, int(period))
-            elif calculation == "thermal_humidity_index" and self.check_read_parquet_from_hdfs(region):
-                result = Calculator.calculate_thi(region, self.data, int(period))
-            elif calculation == "dew_point_range" and self.check_read_parquet_from_hdfs(region):
-                result = Calculator.calculate_dew_point_range(region, self.data, int(period))
-            elif calculation == "air_temp_variability" and self.check_read_parquet_from_hdfs(region):
-                result = Calculator.calculate_air_temp_variability(region, self.data, int(period))
-            else:
-                return f"{request_id}:{calculation}:{region}:{period}:failure"
-            result_str = result.to_json()
-            self.comm.send_info(f"Successfully finished processing:{calculation} for {region} duration: {period}")
-            self.comm.send_info(f"Sending result to DAO: {calculation} for {region} for {period}")
-            self.comm.client.publish("database", f"{calculation}:{result_str}")
-            return f"{request_id}:{calculation}:{region}:{period}:success"
+            self.submit(self.handle_calculation, *parts)
+            return None
+
+    @staticmethod
+    def failure_response(request_id, command, region, argument):
+        # Every task of the request failed, argument is the batch specification or the period
+        if command == "batch":
+            outcome = ";".join(f"{item}=failure" for item in argument.split(";"))
+            return f"{request_id}:{command}:{region}:{outcome}"
+        return f"{request_id}:{command}:{region}:{argument}:failure"
+
+    def handle_batch(self, request_id, command, region, specification):
+        # request_id:batch:region:operation=period;operation=period;...
+        items = specification.split(";")
+        tasks = {}
+        for item in items:
+            calculation, _, period = item.partition("=")
+            if calculation in self.calculations and period.isdigit():
+                tasks[item] = (calculation, int(period))
+        results = self.calculate(region, list(dict.fromkeys(tasks.values()))) if tasks else {}
+        self.publish_results(region, results)
+        outcome = ";".join(f"{item}={'success' if results.get(tasks.get(item)) is not None else 'failure'}"
+                           for item in items)
+        return f"{request_id}:{command}:{region}:{outcome}"
+
+    def handle_calculation(self, request_id, calculation, region, period):
+        if calculation not in self.calculations or not period.isdigit():
+            return f"{request_id}:{calculation}:{region}:{period}:failure"
+        results = self.calculate(region, [(calculation, int(period))])
+        self.publish_results(region, results)
+        if results[(calculation, int(period))] is None:
+            return f"{request_id}:{calculation}:{region}:{period}:failure"
+        return f"{request_id}:{calculation}:{region}:{period}:success"
 
 
 def main():
-    processor = Processor('http://hadoop-container', 9870, 'root')
+    processor = Processor('http://hadoop-container', 9870, 'root', 'configuration.json')
     processor.comm.start(processor.handle_request)
+    announce_thread = threading.Thread(target=processor.announce, daemon=True)
+    announce_thread.start()
     processor.shutdown_event.wait()
+    processor.pool.shutdown(wait=True)
     processor.comm.send_info("Shutting down communication...")
     processor.comm.send_info("Shutting down...")
     processor.comm.stop()
@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+from timewindow import TimeWindow
+
+
+class ResultCache:
+    def __init__(self, memory_budget, exact_operations):
+        # (operation, region, dataset version) -> (longest period computed so far, newest data date, result)
+        self.memory_budget = memory_budget
+        # Operations whose every row depends on the whole window can't be cut from a longer result, their
+        # results are kept per period
+        self.exact_operations = set(exact_operations)
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.sizes = {}
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def slice(result, latest_date, months_back):
+        # Results hold one row per prov/month, the shorter window is cut from the newest data date and not from the
+        # newest result row, operations that leave months out would otherwise shift the window back
+        if result.empty:
+            return result
+        return result[result['date'] >= TimeWindow.start(latest_date, months_back)]
+
+    def key(self, operation, region, version, months_back):
+        if operation in self.exact_operations:
+            return operation, region, version, months_back
+        return operation, region, version
+
+    def get(self, operation, region, version, months_back):
+        key = self.key(operation, region, version, months_back)
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is None or entry[0] < months_back:
+                self.misses += 1
+                return None
+            self.results.move_to_end(key)
+            self.hits += 1
+            period, latest_date, result = entry
+        return result if period == months_back else self.slice(result, latest_date, months_back)
+
+    def put(self, operation, region, version, months_back, latest_date, result):
+        key = self.key(operation, region, version, months_back)
+        size = int(result.memory_usage(deep=True).sum())
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is not None and entry[0] >= months_back:
+                return
+            if entry is not None:
+                self.memory_used -= self.sizes.pop(key)
+                del self.results[key]
+            self.results[key] = (months_back, latest_date, result)
+            self.sizes[key] = size
+            self.memory_used += size
+            while self.memory_used > self.memory_budget and len(self.results) > 1:
+                evicted, _ = self.results.popitem(last=False)
+                self.memory_used -= self.sizes.pop(evicted)
+                self.evictions += 1
+
+    def invalidate(self, region):
+        with self.lock:
+            for key in [key for key in self.results if key[1] == region]:
+                self.memory_used -= self.sizes.pop(key)
+                del self.results[key]
+
+    def stats(self):
+        with self.lock:
+            return (f"results={len(self.results)}, memory={self.memory_used // 1024}KB/"
+                    f"{self.memory_budget // 1024}KB, hits={self.hits}, misses={self.misses}, "
+                    f"evictions={self.evictions}")
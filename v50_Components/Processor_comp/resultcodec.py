@@ -0,0 +1,47 @@
+import json
+import struct
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+class ResultCodec:
+    # Binary result message on the database topic: magic, header length, JSON header, Arrow IPC stream.
+    # JSON results (operation:json) never start with the magic, so both formats can share the topic
+    MAGIC = b"BWRA"
+    SCHEMA_VERSION = 1
+
+    @staticmethod
+    def encode(operation, region, period, result, compression=None):
+        header = json.dumps({"operation": operation, "region": region, "period": period,
+                             "schema_version": ResultCodec.SCHEMA_VERSION}).encode('utf-8')
+        # pandas metadata is dropped, it is often larger than a monthly result itself
+        table = pa.Table.from_pandas(result, preserve_index=False).replace_schema_metadata(None)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression=compression)) as writer:
+            writer.write_table(table)
+        return ResultCodec.MAGIC + struct.pack('>I', len(header)) + header + sink.getvalue().to_pybytes()
+
+    @staticmethod
+    def is_encoded(payload):
+        return isinstance(payload, (bytes, bytearray)) and payload[:len(ResultCodec.MAGIC)] == ResultCodec.MAGIC
+
+    @staticmethod
+    def decode(payload):
+        # Returns the header and the result table, the table reads its buffers straight from the payload
+        offset = len(ResultCodec.MAGIC)
+        (header_length,) = struct.unpack_from('>I', payload, offset)
+        offset += 4
+        header = json.loads(bytes(payload[offset:offset + header_length]).decode('utf-8'))
+        if header["schema_version"] != ResultCodec.SCHEMA_VERSION:
+            raise ValueError(f"unsupported result schema version {header['schema_version']}")
+        buffer = pa.py_buffer(payload)[offset + header_length:]
+        return header, pa.ipc.open_stream(buffer).read_all()
+
+    @staticmethod
+    def to_frame(table):
+        # Timestamps as epoch milliseconds, the same values JSON results are stored with
+        for index, field in enumerate(table.schema):
+            if pa.types.is_timestamp(field.type):
+                table = table.set_column(index, field.name,
+                                         pc.cast(pc.cast(table.column(index), pa.timestamp('ms')), pa.int64()))
+        return table.to_pandas()
@@ -0,0 +1,181 @@
+import numpy as np
+import pandas as pd
+from timewindow import TimeWindow
+
+
+class Moments:
+    # Mergeable count/mean/M2 (Welford) state with min and max, one row per group
+
+    @staticmethod
+    def partial(frame, keys, column):
+        values = frame[column].astype('float64')
+        grouped = values[values.notna()].groupby([frame[key] for key in keys])
+        count = grouped.count()
+        return pd.DataFrame({'count': count, 'mean': grouped.mean(), 'm2': grouped.var(ddof=0) * count,
+                             'min': grouped.min(), 'max': grouped.max()})
+
+    @staticmethod
+    def merge(state, partial):
+        if state is None:
+            return partial
+        index = state.index.union(partial.index)
+        a = state.reindex(index)
+        b = partial.reindex(index)
+        count_a = a['count'].fillna(0)
+        count_b = b['count'].fillna(0)
+        count = count_a + count_b
+        # Chan et al. parallel update, a group missing on one side keeps the other side as is
+        delta = b['mean'].fillna(0) - a['mean'].fillna(0)
+        mean = a['mean'].fillna(0) + delta * count_b / count
+        m2 = a['m2'].fillna(0) + b['m2'].fillna(0) + delta * delta * count_a * count_b / count
+        return pd.DataFrame({'count': count, 'mean': mean, 'm2': m2,
+                             'min': np.fmin(a['min'], b['min']), 'max': np.fmax(a['max'], b['max'])})
+
+    @staticmethod
+    def std(state):
+        # Sample standard deviation (ddof=1), NaN for a single value like pandas
+        return np.sqrt(state['m2'] / (state['count'] - 1)).where(state['count'] > 1)
+
+
+class Counts:
+    # Additive state (counts, sums, histogram bins), partials are merged by adding them up
+
+    @staticmethod
+    def partial(frame, keys, column):
+        values = frame[column].astype('float64')
+        grouped = values[values.notna()].groupby([frame[key] for key in keys])
+        return pd.DataFrame({'count': grouped.count(), 'sum': grouped.sum()})
+
+    @staticmethod
+    def merge(state, partial):
+        if state is None:
+            return partial
+        return state.add(partial, fill_value=0)
+
+
+class StreamingCalculator:
+    MONTH = ['prov', 'year', 'month']
+    DIRECTIONS = ['N', 'E', 'S', 'W']
+
+    def __init__(self, region, operation, months_back, latest_date):
+        # Consumes the region one record batch at a time, memory is bounded by the number of groups, not rows
+        self.region = region
+        self.operation = operation
+        self.state = None
+        consume, finish = {
+            "avg_temp": (self.consume_avg_temp, self.finish_avg_temp),
+            "total_rainfall": (self.consume_total_rainfall, self.finish_total_rainfall),
+            "pressure_extremes": (self.consume_pressure_extremes, self.finish_pressure_extremes),
+            "wind_speed": (self.consume_wind_speed, self.finish_wind_speed),
+            "solar_radiation": (self.consume_solar_radiation, self.finish_solar_radiation),
+            "wind_direction_distribution": (self.consume_wind_direction, self.finish_wind_direction),
+            "humidity_variability": (self.consume_humidity_variability, self.finish_humidity_variability),
+            "thermal_humidity_index": (self.consume_thi, self.finish_thi),
+            "dew_point_range": (self.consume_dew_point_range, self.finish_dew_point_range),
+            "air_temp_variability": (self.consume_air_temp_variability, self.finish_air_temp_variability)
+        }[operation]
+        self.consume_window = consume
+        self.finish = finish
+        # Same calendar month window as Calculator
+        self.cutoff = TimeWindow.start(latest_date, months_back)
+
+    def consume(self, frame):
+        frame = frame[frame['date'] >= self.cutoff]
+        if len(frame):
+            self.consume_window(frame)
+
+    def result(self):
+        if self.state is None:
+            raise ValueError(f"no data in the requested window for {self.region}")
+        return self.finish()
+
+    def label(self, result):
+        result['period'] = result['year'].astype(str) + result['month'].astype(str).str.zfill(2)
+        result['region'] = self.region
+        result['date'] = pd.to_datetime(result['period'], format='%Y%m')
+        return result.sort_values(by=['prov', 'period'])
+
+    def consume_avg_temp(self, frame):
+        self.state = Moments.merge(self.state, Moments.partial(frame, self.MONTH, 'temp'))
+
+    def finish_avg_temp(self):
+        return self.label(self.state['mean'].rename('avg_temp').reset_index())
+
+    def consume_total_rainfall(self, frame):
+        self.state = Counts.merge(self.state, Counts.partial(frame, self.MONTH + ['hour'], 'prcp'))
+
+    def finish_total_rainfall(self):
+        by_hour = self.state['sum'] / self.state['count']
+        return self.label(by_hour.groupby(level=self.MONTH).sum().reset_index(name='total_rainfall'))
+
+    def consume_pressure_extremes(self, frame):
+        self.state = Moments.merge(self.state, Moments.partial(frame, self.MONTH, 'stp'))
+
+    def finish_pressure_extremes(self):
+        result = self.state[['max', 'min']].rename(columns={'max': 'max_pressure', 'min': 'min_pressure'})
+        return self.label(result.reset_index())
+
+    def consume_wind_speed(self, frame):
+        self.state = Moments.merge(self.state, Moments.partial(frame, self.MONTH, 'wdsp'))
+
+    def finish_wind_speed(self):
+        result = self.state['mean'].rename('avg_wind_speed').reset_index()
+        # Mean deviation from the monthly mean is zero by definition
+        result['avg_wind_speed_deviation'] = 0.0
+        return self.label(result)
+
+    def consume_solar_radiation(self, frame):
+        # Daily means are needed for the per prov average, monthly reading counts come from the same state
+        self.state = Counts.merge(self.state, Counts.partial(frame, ['prov', 'date'], 'gbrd'))
+
+    def finish_solar_radiation(self):
+        daily = self.state[self.state['count'] > 0].reset_index()
+        average = (daily['sum'] / daily['count']).groupby(daily['prov']).mean()
+        result = daily.groupby(['prov', daily['date'].dt.year.rename('year'),
+                                daily['date'].dt.month.rename('month')])['count'].sum().reset_index()
+        days = pd.to_datetime(result['year'].astype(str) + '-' + result['month'].astype(str)).dt.daysinmonth
+        result['total_solar_radiation'] = result['prov'].map(average) * result['count'] * days
+        return self.label(result[self.MONTH + ['total_solar_radiation']])
+
+    def consume_wind_direction(self, frame):
+        frame = frame[frame['wdct'].notna()]
+        if not len(frame):
+            return
+        direction = frame['wdct'].replace(360, 0)
+        ranges = pd.cut(direction, bins=[0, 90, 180, 270, 359], labels=self.DIRECTIONS, include_lowest=True)
+        partial = pd.crosstab([frame[key] for key in self.MONTH], ranges, dropna=False)
+        partial = partial.reindex(columns=self.DIRECTIONS, fill_value=0)
+        self.state = Counts.merge(self.state, partial)
+
+    def finish_wind_direction(self):
+        result = self.label(self.state.astype('int64').reset_index())
+        result.columns.name = None
+        # Months missing any direction are left out, same as Calculator
+        return result.loc[~(result[self.DIRECTIONS] == 0).any(axis=1)]
+
+    def consume_humidity_variability(self, frame):
+        self.state = Moments.merge(self.state, Moments.partial(frame, self.MONTH, 'hmdy'))
+
+    def finish_humidity_variability(self):
+        return self.label(Moments.std(self.state).rename('humidity_std_dev').reset_index())
+
+    def consume_thi(self, frame):
+        thi = 0.8 * frame['temp'] + (frame['hmdy'] * (frame['temp'] - 14.4)) / 100 + 46.4
+        self.state = Moments.merge(self.state, Moments.partial(frame.assign(thi=thi), self.MONTH, 'thi'))
+
+    def finish_thi(self):
+        return self.label(self.state['mean'].rename('avg_thi').reset_index())
+
+    def consume_dew_point_range(self, frame):
+        self.state = Moments.merge(self.state, Moments.partial(frame, self.MONTH, 'dewp'))
+
+    def finish_dew_point_range(self):
+        result = self.state[['max', 'min']].rename(columns={'max': 'max_dewp', 'min': 'min_dewp'}).reset_index()
+        result['dew_point_range'] = result['max_dewp'] - result['min_dewp']
+        return self.label(result)
+
+    def consume_air_temp_variability(self, frame):
+        self.state = Moments.merge(self.state, Moments.partial(frame, self.MONTH, 'temp'))
+
+    def finish_air_temp_variability(self):
+        return self.label(Moments.std(self.state).rename('temp_std_dev').reset_index())
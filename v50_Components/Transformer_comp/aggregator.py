@@ -0,0 +1,102 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from hdfsfile import HdfsFile
+from hdfsstream import HdfsStream
+
+
+class Aggregator:
+    # Measurements kept in the daily cube, thi is derived from temp and hmdy
+    MEASURES = ['temp', 'prcp', 'stp', 'wdsp', 'gbrd', 'hmdy', 'dewp', 'wdct', 'thi']
+    # Same buckets as Calculator.calculate_wind_direction_distribution, 360 degrees counts as 0
+    WIND_DIRECTIONS = [('N', 0, 90), ('E', 90, 180), ('S', 180, 270), ('W', 270, 359)]
+
+    def __init__(self, hdfs_client, compression, compression_level):
+        self.hdfs_client = hdfs_client
+        self.compression = compression
+        self.compression_level = compression_level
+
+    def daily_partial(self, table):
+        # Count, sum, sum of squares, min and max per prov/day for every measurement plus wind direction buckets
+        columns = {'prov': pc.cast(table['prov'], pa.string()),
+                   'date': pc.floor_temporal(table['timestamp'], unit='day')}
+        for measure in self.MEASURES:
+            if measure == 'thi':
+                temp = pc.cast(table['temp'], pa.float64())
+                hmdy = pc.cast(table['hmdy'], pa.float64())
+                values = pc.add(pc.add(pc.multiply(temp, 0.8),
+                                       pc.divide(pc.multiply(hmdy, pc.subtract(temp, 14.4)), 100)), 46.4)
+            else:
+                values = pc.cast(table[measure], pa.float64())
+            columns[measure] = values
+            columns[f'{measure}_sq'] = pc.multiply(values, values)
+        direction = pc.if_else(pc.equal(table['wdct'], 360), pa.scalar(0, table['wdct'].type), table['wdct'])
+        for label, low, high in self.WIND_DIRECTIONS:
+            above = pc.greater_equal(direction, low) if low == 0 else pc.greater(direction, low)
+            columns[f'wdct_{label}'] = pc.cast(pc.fill_null(pc.and_(above, pc.less_equal(direction, high)), False),
+                                               pa.int64())
+        aggregations = []
+        for measure in self.MEASURES:
+            aggregations += [(measure, 'count'), (measure, 'sum'), (f'{measure}_sq', 'sum'),
+                             (measure, 'min'), (measure, 'max')]
+        aggregations += [(f'wdct_{label}', 'sum') for label, _, _ in self.WIND_DIRECTIONS]
+        return self.rename(pa.table(columns).group_by(['prov', 'date']).aggregate(aggregations))
+
+    @staticmethod
+    def hourly_partial(table):
+        # Rainfall is averaged per hour of the month before summing, so it needs an hourly breakdown
+        columns = {'prov': pc.cast(table['prov'], pa.string()),
+                   'date': pc.floor_temporal(table['timestamp'], unit='day'),
+                   'hour': pc.cast(pc.hour(table['timestamp']), pa.int8()),
+                   'prcp': pc.cast(table['prcp'], pa.float64())}
+        partial = pa.table(columns).group_by(['prov', 'date', 'hour']).aggregate([('prcp', 'count'), ('prcp', 'sum')])
+        return Aggregator.rename(partial)
+
+    @staticmethod
+    def rename(table):
+        # group_by names outputs column_function, cube columns are column_state (temp_sum, temp_sq_sum -> temp_sumsq)
+        names = [name.replace('_sq_sum', '_sumsq') for name in table.column_names]
+        return table.rename_columns(names)
+
+    @staticmethod
+    def merge(table, keys):
+        # Partial states of the same key coming from different row groups are combined into one
+        aggregations = []
+        for name in table.column_names:
+            if name in keys:
+                continue
+            function = name.rsplit('_', 1)[1]
+            aggregations.append((name, {'count': 'sum', 'sum': 'sum', 'sumsq': 'sum', 'min': 'min',
+                                        'max': 'max'}.get(function, 'sum')))
+        merged = table.group_by(keys).aggregate(aggregations)
+        return merged.rename_columns([name if name in keys else name.rsplit('_', 1)[0]
+                                      for name in merged.column_names])
+
+    def build(self, paths):
+        daily = None
+        hourly = None
+        for path in paths:
+            source = pq.ParquetFile(HdfsFile(self.hdfs_client, path), pre_buffer=True)
+            for index in range(source.num_row_groups):
+                row_group = source.read_row_group(index, columns=['timestamp', 'prov', 'prcp', 'stp', 'gbrd', 'temp',
+                                                                  'dewp', 'hmdy', 'wdct', 'wdsp'])
+                daily = self.combine(daily, self.daily_partial(row_group), ['prov', 'date'])
+                hourly = self.combine(hourly, self.hourly_partial(row_group), ['prov', 'date', 'hour'])
+        if daily is None:
+            raise ValueError("no curated data to aggregate")
+        # Empty sums are NULL in arrow, the cube keeps 0 so states stay additive
+        daily, hourly = [pa.table({name: pc.fill_null(column, 0) if name.endswith(('_count', '_sum', '_sumsq'))
+                                   else column for name, column in zip(table.column_names, table.columns)})
+                         for table in (daily, hourly)]
+        # Sorted by date so the Processor can cut windows with a binary search
+        return (daily.sort_by([('date', 'ascending'), ('prov', 'ascending')]),
+                hourly.sort_by([('date', 'ascending'), ('prov', 'ascending'), ('hour', 'ascending')]))
+
+    def combine(self, state, partial, keys):
+        if state is None:
+            return partial
+        return self.merge(pa.concat_tables([state, partial]), keys)
+
+    def write(self, table, hdfs_path):
+        with HdfsStream(self.hdfs_client, hdfs_path) as target:
+            pq.write_table(table, target, compression=self.compression, compression_level=self.compression_level)
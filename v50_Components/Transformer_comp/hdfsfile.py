@@ -0,0 +1,46 @@
+import io
+
+
+class HdfsFile(io.RawIOBase):
+    def __init__(self, hdfs_client, hdfs_path):
+        super().__init__()
+        # Random access over WebHDFS offset/length reads, so parquet readers only fetch the byte ranges they need
+        self.hdfs_client = hdfs_client
+        self.hdfs_path = hdfs_path
+        self.size = hdfs_client.status(hdfs_path)['length']
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0 or self.position + size > self.size:
+            size = self.size - self.position
+        if size <= 0:
+            return b''
+        with self.hdfs_client.read(self.hdfs_path, offset=self.position, length=size) as reader:
+            data = reader.read()
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
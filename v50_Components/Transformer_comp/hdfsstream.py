@@ -0,0 +1,88 @@
+import io
+import queue
+import threading
+
+
+class HdfsStream(io.RawIOBase):
+    # Put in place of a chunk to make the upload fail instead of completing the file
+    ABORT = object()
+
+    def __init__(self, hdfs_client, hdfs_path, max_chunks=16):
+        super().__init__()
+        self.hdfs_client = hdfs_client
+        self.hdfs_path = hdfs_path
+        # Written next to the target and renamed over it once complete, so a failed write never replaces a good file.
+        # The leading underscore keeps readers that list the directory away from it
+        directory, _, name = hdfs_path.rpartition('/')
+        self.temp_path = f"{directory}/_{name}.tmp"
+        # Bounded so a slow upload holds back the writer instead of buffering the whole file
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.error = None
+        self.upload = threading.Thread(target=self.run_upload, args=(hdfs_client, self.temp_path))
+        self.upload.start()
+
+    def run_upload(self, hdfs_client, hdfs_path):
+        try:
+            hdfs_client.write(hdfs_path, data=self.read_chunks(), overwrite=True)
+        except Exception as e:
+            self.error = e
+
+    def read_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if chunk is HdfsStream.ABORT:
+                raise IOError(f"Upload of {self.hdfs_path} aborted")
+            yield chunk
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        chunk = bytes(data)
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return len(chunk)
+            except queue.Full:
+                continue
+
+    def finish_upload(self, sentinel):
+        while self.upload.is_alive():
+            try:
+                self.chunks.put(sentinel, timeout=1)
+                break
+            except queue.Full:
+                continue
+        self.upload.join()
+
+    def abort(self):
+        # Writer failed, whatever was sent so far is thrown away and the target stays as it was
+        if not self.closed:
+            self.finish_upload(HdfsStream.ABORT)
+            self.hdfs_client.delete(self.temp_path)
+        super().close()
+
+    def close(self):
+        if not self.closed:
+            self.finish_upload(None)
+            if self.error is None:
+                try:
+                    self.hdfs_client.delete(self.hdfs_path)
+                    self.hdfs_client.rename(self.temp_path, self.hdfs_path)
+                except Exception as e:
+                    self.error = e
+            if self.error is not None:
+                self.hdfs_client.delete(self.temp_path)
+        super().close()
+        if self.error is not None:
+            raise self.error
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
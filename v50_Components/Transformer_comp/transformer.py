@@ -1,36 +1,232 @@
+import json
 import time
-import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import os
-import numpy as np
 from hdfs import InsecureClient
 import threading
+from contextlib import ExitStack
 from comm import Comm
+from aggregator import Aggregator
+from hdfsfile import HdfsFile
+from hdfsstream import HdfsStream
 
 
 class Transformer:
-    def __init__(self, hdfs_host, hdfs_port, hdfs_user):
+    def __init__(self, hdfs_host, hdfs_port, hdfs_user, configuration):
         self.hdfs_client = InsecureClient(f"{hdfs_host}:{hdfs_port}", user=hdfs_user)
+        with open(configuration, 'r') as file:
+            config_data = json.load(file)
+            self.partitioned = bool(config_data["partitioned"])
+            self.compression = config_data["compression"]
+            # Only some codecs take a level (zstd, gzip, brotli, lz4), snappy and none reject one so it is dropped
+            self.compression_level = config_data["compression_level"]
+            if self.compression_level is not None and (str(self.compression).lower() == "none" or
+                                                       not pa.Codec.supports_compression_level(self.compression)):
+                self.compression_level = None
+            # drop_row removes the whole row when the column is missing, null_cell keeps the row with a NULL cell
+            self.null_policy = config_data["null_policy"]
+            # Rows of a single file region sorted in memory at once, bigger regions are sorted in several passes
+            self.sort_memory_bytes = int(config_data["sort_memory_mb"]) * 1024 * 1024
+        # Settings that change the curated output, a change forces transformation of unchanged sources
+        self.output_settings = {"partitioned": self.partitioned, "compression": self.compression,
+                                "compression_level": self.compression_level, "null_policy": self.null_policy,
+                                "order": "timestamp"}
+        self.aggregator = Aggregator(self.hdfs_client, self.compression, self.compression_level)
         self.shutdown_event = threading.Event()
 
-    def read_parquet_from_hdfs(self, hdfs_path):
-        with self.hdfs_client.read(hdfs_path) as reader:
-            data = reader.read()
-            return pq.read_table(pa.BufferReader(data)).to_pandas()
+    def column_policy(self, column):
+        return self.null_policy["columns"].get(column, self.null_policy["default"])
+
+    def clean_batch(self, batch):
+        # Sentinel replacement, null masks and row filter in a single pass over the batch
+        columns = []
+        valid = None
+        for field, column in zip(batch.schema, batch.columns):
+            if pa.types.is_floating(field.type):
+                column = pc.if_else(pc.equal(column, -9999), pa.scalar(None, field.type), column)
+            if self.column_policy(field.name) == "drop_row":
+                mask = pc.is_valid(column)
+                valid = mask if valid is None else pc.and_(valid, mask)
+            columns.append(column)
+        cleaned = pa.RecordBatch.from_arrays(columns, schema=batch.schema)
+        return cleaned if valid is None else cleaned.filter(valid)
+
+    def clean_parquet(self, source_path, target_path):
+        # Row group in, row group out, only one row group of the region is held in memory
+        source = pq.ParquetFile(HdfsFile(self.hdfs_client, source_path), pre_buffer=True)
+        schema = source.schema_arrow
+        with HdfsStream(self.hdfs_client, target_path) as target:
+            with pq.ParquetWriter(target, schema, compression=self.compression,
+                                  compression_level=self.compression_level) as writer:
+                for index in range(source.num_row_groups):
+                    row_group = source.read_row_group(index)
+                    writer.write_table(self.clean_row_group(row_group, schema),
+                                       row_group_size=max(1, row_group.num_rows))
+
+    def clean_row_group(self, row_group, schema):
+        return pa.Table.from_batches([self.clean_batch(batch) for batch in row_group.to_batches()], schema=schema)
+
+    def clean_sorted_parquet(self, source_path, target_path):
+        # Loaded csv is ordered by station, so every row group spans the whole period and timestamp statistics
+        # cannot skip anything. Curated rows are written in timestamp order: the source is read and cleaned once,
+        # its rows are spilled to one temporary file per time range and every range, small enough to be sorted
+        # within sort_memory_mb, is sorted and appended to the target
+        source = pq.ParquetFile(HdfsFile(self.hdfs_client, source_path), pre_buffer=True)
+        schema = source.schema_arrow
+        row_group_size = max([source.metadata.row_group(index).num_rows
+                              for index in range(source.num_row_groups)], default=1)
+        ranges = self.time_ranges(source)
+        if len(ranges) == 1:
+            pieces = [self.clean_row_group(source.read_row_group(index), schema)
+                      for index in range(source.num_row_groups)]
+            self.write_sorted(target_path, schema, [pa.concat_tables(pieces)] if pieces else [], row_group_size)
+            return
+        directory, _, name = target_path.rpartition('/')
+        spill_paths = [f"{directory}/_{name}.range{index}" for index in range(len(ranges))]
+        try:
+            with ExitStack() as stack:
+                spills = []
+                for path in spill_paths:
+                    spill = stack.enter_context(HdfsStream(self.hdfs_client, path))
+                    spills.append(stack.enter_context(pq.ParquetWriter(spill, schema, compression=self.compression,
+                                                                       compression_level=self.compression_level)))
+                for index in range(source.num_row_groups):
+                    cleaned = self.clean_row_group(source.read_row_group(index), schema)
+                    for (start, stop), spill in zip(ranges, spills):
+                        piece = cleaned.filter(self.in_range(cleaned['timestamp'], start, stop))
+                        if piece.num_rows:
+                            spill.write_table(piece, row_group_size=max(1, piece.num_rows))
+            self.write_sorted(target_path, schema, (pq.read_table(HdfsFile(self.hdfs_client, path))
+                                                    for path in spill_paths), row_group_size)
+        finally:
+            for path in spill_paths:
+                self.hdfs_client.delete(path)
+
+    def write_sorted(self, target_path, schema, tables, row_group_size):
+        # Tables hold consecutive time ranges, each one is sorted on its own and appended in order
+        with HdfsStream(self.hdfs_client, target_path) as target:
+            with pq.ParquetWriter(target, schema, compression=self.compression,
+                                  compression_level=self.compression_level) as writer:
+                for table in tables:
+                    table = table.sort_by('timestamp')
+                    if table.num_rows:
+                        writer.write_table(table, row_group_size=max(1, row_group_size))
 
     @staticmethod
-    def clean_data(df):
-        for column in df.columns:
-            df[column].replace(-9999, np.nan, inplace=True)
-        df.dropna(inplace=True)
-        return df
-
-    def write_parquet_to_hdfs(self, df, hdfs_path):
-        buffer = pa.BufferOutputStream()
-        pq.write_table(pa.Table.from_pandas(df), buffer)
-        with self.hdfs_client.write(hdfs_path, overwrite=True) as writer:
-            writer.write(buffer.getvalue())
+    def in_range(timestamps, start, stop):
+        # Days in [start, stop), the last range (stop is None) also takes the rows without a timestamp
+        days = pc.cast(timestamps, pa.date32())
+        if stop is None:
+            return pc.or_kleene(pc.greater_equal(days, start), pc.is_null(days))
+        return pc.and_kleene(pc.greater_equal(days, start), pc.less(days, stop))
+
+    def time_ranges(self, source):
+        # Whole days grouped into ranges of at most sort_memory_mb, sized from the timestamp column only
+        metadata = source.metadata
+        if not metadata.num_rows:
+            return [(None, None)]
+        row_bytes = max(1, sum(metadata.row_group(index).total_byte_size
+                               for index in range(metadata.num_row_groups)) // metadata.num_rows)
+        budget_rows = max(1, self.sort_memory_bytes // row_bytes)
+        if metadata.num_rows <= budget_rows:
+            return [(None, None)]
+        counts = pc.value_counts(pc.cast(source.read(columns=['timestamp'])['timestamp'], pa.date32()))
+        days = sorted((day, count) for day, count in zip(counts.field('values').to_pylist(),
+                                                       counts.field('counts').to_pylist()) if day is not None)
+        if not days:
+            return [(None, None)]
+        starts = [days[0][0]]
+        rows = 0
+        for day, count in days:
+            if rows and rows + count > budget_rows:
+                starts.append(day)
+                rows = 0
+            rows += count
+        return list(zip(starts, starts[1:] + [None]))
+
+    def transform_region(self, region):
+        if self.partitioned:
+            source_manifest_path = f'/datalake/transformed/{region}/_manifest.json'
+            manifest_path = f'/datalake/curated/{region}/_manifest.json'
+        else:
+            source_manifest_path = f'/datalake/transformed/{region}.manifest.json'
+            manifest_path = f'/datalake/curated/{region}.manifest.json'
+
+        # Curated output is current when it was built from the same loaded source with the same settings. Loader
+        # settings are part of the source, so a reload with other settings is transformed again too
+        source_manifest = self.read_manifest(source_manifest_path)
+        source = self.source_identity(source_manifest) if source_manifest is not None else None
+        manifest = self.read_manifest(manifest_path)
+        if (source is not None and manifest is not None and manifest["settings"] == self.output_settings
+                and manifest.get("source") == source):
+            return False
+
+        self.hdfs_client.delete(manifest_path)
+        if not self.partitioned:
+            self.clean_sorted_parquet(f'/datalake/transformed/{region}.parquet',
+                                      f'/datalake/curated/{region}.parquet')
+        else:
+            # Partitions are cleaned one by one and keep their prov=../year=../month=.. location in the curated zone
+            source_root = f'/datalake/transformed/{region}'
+            target_root = f'/datalake/curated/{region}'
+            self.hdfs_client.delete(target_root, recursive=True)
+            for directory, _, files in self.hdfs_client.walk(source_root):
+                for file in files:
+                    if file.startswith('_'):
+                        continue
+                    partition_path = f"{directory}/{file}"
+                    self.clean_parquet(partition_path, target_root + partition_path[len(source_root):])
+
+        if source is not None:
+            self.write_manifest(manifest_path, {
+                "source": source,
+                "settings": self.output_settings
+            })
+        return True
+
+    @staticmethod
+    def source_identity(source_manifest):
+        # mtime_ns is left out, Loader rewrites it when the csv is only touched and the upload is skipped
+        return {key: source_manifest[key] for key in ("sha256", "size", "settings")}
+
+    def curated_paths(self, region):
+        if not self.partitioned:
+            return [f'/datalake/curated/{region}.parquet']
+        root = f'/datalake/curated/{region}'
+        return [f"{directory}/{file}" for directory, _, files in self.hdfs_client.walk(root)
+                for file in files if not file.startswith('_')]
+
+    def aggregate_region(self, region):
+        if self.partitioned:
+            curated_manifest_path = f'/datalake/curated/{region}/_manifest.json'
+        else:
+            curated_manifest_path = f'/datalake/curated/{region}.manifest.json'
+        manifest_path = f'/datalake/aggregated/{region}/_manifest.json'
+
+        # Cube is current when it was built from the same curated output
+        curated_manifest = self.read_manifest(curated_manifest_path)
+        manifest = self.read_manifest(manifest_path)
+        if curated_manifest is not None and manifest is not None and manifest["curated"] == curated_manifest:
+            return False
+
+        self.hdfs_client.delete(manifest_path)
+        daily, hourly = self.aggregator.build(self.curated_paths(region))
+        self.aggregator.write(daily, f'/datalake/aggregated/{region}/daily.parquet')
+        self.aggregator.write(hourly, f'/datalake/aggregated/{region}/hourly.parquet')
+        if curated_manifest is not None:
+            self.write_manifest(manifest_path, {"curated": curated_manifest})
+        return True
+
+    def read_manifest(self, manifest_path):
+        if self.hdfs_client.status(manifest_path, strict=False) is None:
+            return None
+        with self.hdfs_client.read(manifest_path, encoding='utf-8') as reader:
+            return json.load(reader)
+
+    def write_manifest(self, manifest_path, manifest):
+        self.hdfs_client.write(manifest_path, json.dumps(manifest), encoding='utf-8', overwrite=True)
 
     def handle_request(self, payload, comm):
         parts = payload.split(":")
@@ -41,17 +237,22 @@ class Transformer:
         if command == "transform":
             comm.send_info(f"Received request to transform {region}")
             try:
-                path = f'/datalake/transformed/{region}.parquet'
-                comm.send_info(f"Cleaning data for {region}...")
-                df = self.read_parquet_from_hdfs(path)
-                cleaned_df = self.clean_data(df)
-                output_path = f'/datalake/curated/{region}.parquet'
-                comm.send_info(f"Uploading clean {region} to HDFS...")
-                self.write_parquet_to_hdfs(cleaned_df, output_path)
+                comm.send_info(f"Cleaning data for {region} and uploading it to HDFS...")
+                if not self.transform_region(region):
+                    comm.send_info(f"Curated {region} is up to date with its source, skipping.")
                 return f"{request_id}:{command}:{region}:success"
             except Exception as e:
                 comm.send_info(f"Error transforming data for {region}: {e}")
                 return f"{request_id}:{command}:{region}:failure"
+        elif command == "aggregate":
+            comm.send_info(f"Received request to aggregate {region}")
+            try:
+                if not self.aggregate_region(region):
+                    comm.send_info(f"Aggregated {region} is up to date with curated data, skipping.")
+                return f"{request_id}:{command}:{region}:success"
+            except Exception as e:
+                comm.send_info(f"Error aggregating data for {region}: {e}")
+                return f"{request_id}:{command}:{region}:failure"
         elif command == "alive" and region == "request":
             comm.send_info("Alive => Running...")
             return f"{request_id}:transformer:alive:waiting"
@@ -65,7 +266,7 @@ class Transformer:
 
 
 def main():
-    transformer = Transformer('http://hadoop-container', 9870, 'root')
+    transformer = Transformer('http://hadoop-container', 9870, 'root', 'configuration.json')
     comm = Comm("mqtt-broker", "transformer", "response")
 
     comm.start(transformer.handle_request)
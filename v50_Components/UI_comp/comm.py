@@ -1,4 +1,5 @@
 from paho.mqtt.client import Client
+from resultcodec import ResultCodec
 
 class Comm:
     def __init__(self, broker_address, request_topic1, request_topic2, response_topic):
@@ -11,8 +12,13 @@ class Comm:
         self.callback = None
 
     def on_message(self, client, userdata, message):
-        payload = str(message.payload.decode('utf-8'))
-        print(f"UISystem: Received request: {payload}")
+        if ResultCodec.is_encoded(message.payload):
+            # Binary results are handed over as they are
+            payload = message.payload
+            print(f"UISystem: Received binary result: {len(payload)} bytes")
+        else:
+            payload = str(message.payload.decode('utf-8'))
+            print(f"UISystem: Received request: {payload}")
 
         if self.callback:
             response = self.callback(payload, message.topic)
@@ -2,18 +2,31 @@ import json
 import sqlite3
 import pandas as pd
 from datetime import datetime
+from resultcodec import ResultCodec
+from timewindow import TimeWindow
 
 
 class DaoHandler:
     @staticmethod
-    def write_to_db(payload):
+    def read_payload(payload):
+        # Returns the table name and the result frame of an Arrow or a JSON result message
+        if ResultCodec.is_encoded(payload):
+            header, table = ResultCodec.decode(payload)
+            return header["operation"], ResultCodec.to_frame(table)
         parts = payload.split(":", 1)
-        if len(parts) == 2:
-            table_name, data_str = parts
-            data = json.loads(data_str)
+        if len(parts) != 2:
+            return None
+        table_name, data_str = parts
+        data = json.loads(data_str)
 
-            # Convert the data to a Pandas DataFrame
-            df = pd.DataFrame(data)
+        # Convert the data to a Pandas DataFrame
+        return table_name, pd.DataFrame(data)
+
+    @staticmethod
+    def write_to_db(payload):
+        message = DaoHandler.read_payload(payload)
+        if message is not None:
+            table_name, df = message
 
             # Create or open the SQLite database
             conn = sqlite3.connect("database.db")
@@ -52,37 +65,30 @@ class DaoHandler:
     @staticmethod
     def get_table(table_name, region, period_months):
         conn = sqlite3.connect("database.db")
-        cursor = conn.cursor()
-
-        # Get the maximum date in the table
-        max_date_query = f"SELECT MAX(date) FROM {table_name}"
-        cursor.execute(max_date_query)
-        max_date = cursor.fetchone()[0]
-        max_timestamp = pd.to_datetime(max_date, unit='ms').timestamp()
-
-        # Calculate the cutoff time for the period
-        cutoff_time = max_timestamp - (period_months * 30 * 24 * 3600)  # Approximate calculation
-
-        # Convert the cutoff time to a datetime object in milliseconds
-        cutoff_date_ms = int(cutoff_time * 1000)
 
         # Construct the query based on the region
         if region == 'all':
             query = f"""
                     SELECT * FROM {table_name}
-                    WHERE date >= {cutoff_date_ms}
                 """
         else:
             query = f"""
                     SELECT * FROM {table_name}
                     WHERE region = '{region}'
-                    AND date >= {cutoff_date_ms}
                 """
 
         result_df = pd.read_sql_query(query, conn)
 
         conn.close()
-        return result_df
+
+        if result_df.empty:
+            return result_df
+
+        # Keep the last "period_months" calendar months of each region, the same window the Processor uses
+        dates = pd.to_datetime(result_df['date'], unit='ms')
+        window_start = {name: TimeWindow.start(newest, period_months)
+                        for name, newest in dates.groupby(result_df['region']).max().items()}
+        return result_df[dates >= result_df['region'].map(window_start)].copy()
 
     @staticmethod
     def get_realtime_table(region):
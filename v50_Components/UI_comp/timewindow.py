@@ -0,0 +1,19 @@
+import pandas as pd
+
+
+class TimeWindow:
+    # "Last N months" for the whole system: the month of the newest record and the N - 1 calendar months before it.
+    # Results are per prov/month, so a window always holds whole months and a result for N months has N months
+
+    @staticmethod
+    def start(latest_date, months_back):
+        # First day of the oldest month in the window
+        first_day = pd.Timestamp(latest_date).normalize().replace(day=1)
+        return first_day - pd.DateOffset(months=max(months_back, 1) - 1)
+
+    @staticmethod
+    def rows(dates, months_back):
+        # (start, stop) row offsets of the window in a frame sorted by date, found with a binary search
+        if len(dates) == 0:
+            return 0, 0
+        return dates.searchsorted(TimeWindow.start(dates.iloc[-1], months_back), side='left'), len(dates)